@@ -0,0 +1,258 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Self-checks for run_speedcenter.py that need no agent build and no
+Codespeed server: a shell script stands in for the agent, and a local
+HTTP server for Codespeed.
+
+    python contrib/codespeed/check_speedcenter.py [CHECK ...]
+"""
+import os
+import sys
+import ast
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+
+import subprocess as sub
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RUN_SPEEDCENTER = os.path.join(HERE, 'run_speedcenter.py')
+
+from run_speedcenter import Spool, Uploader, upload_spool
+
+# an agent of about 5 MB with an idle 80 MB plugin
+FAKE_AGENT = '''#!/bin/sh
+[ "$1" = --version ] && { echo check-revision; exit 0; }
+echo "INF: starting"
+%(python)s -c "
+import time
+x = bytearray(80 * 1024 * 1024); x[::4096] = b'x' * (len(x) // 4096)
+time.sleep(600)" &
+exec %(python)s -c "
+import time
+x = bytearray(5 * 1024 * 1024); x[::4096] = b'x' * (len(x) // 4096)
+time.sleep(600)"
+'''
+
+def run_fake_agent(workdir, *args):
+    agent = os.path.join(workdir, 'fake-agent')
+    with open(agent, 'w') as fp:
+        fp.write(FAKE_AGENT % {'python': sys.executable})
+    os.chmod(agent, 0755)
+    command = [sys.executable, RUN_SPEEDCENTER, '--executable', agent,
+               '--spool', os.path.join(workdir, 'spool.db')] + list(args)
+    started = time.time()
+    p = sub.Popen(command, cwd=workdir, stdout=sub.PIPE, stderr=sub.STDOUT)
+    output = p.communicate()[0]
+    return p.returncode, time.time() - started, output
+
+def results(output):
+    # benchmark name -> Codespeed entry, from the payload the script prints
+    for line in output.splitlines():
+        if line.startswith("{'json'"):
+            return dict((entry['benchmark'], entry)
+                        for entry in ast.literal_eval(line)['json'])
+    return {}
+
+def check_steady_state_with_plugin(workdir):
+    # a plugin much bigger than the agent must not keep RSS out of the
+    # tolerance band, so the run ends long before the --sleep limit
+    status, seconds, output = run_fake_agent(
+        workdir, '--sleep', '60', '--steady-window', '3',
+        '--benchmarks', 'peak-rss,steady-rss')
+    assert status == 0, output
+    assert seconds < 30, 'took %.1fs:\n%s' % (seconds, output)
+    found = results(output)
+    assert 'virgo time to steady state' in found, output
+    # the agent's own memory, not the plugin's
+    assert found['virgo peak memory usage']['result_value'] < 40 * 1024, output
+    assert found['virgo steady-state memory usage']['max'] < 40 * 1024, output
+
+class StandInCodespeed(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Accepts result/add/json/ posts like Codespeed, except that the first
+    `server.failures` requests get `server.failure_status` (503 unless
+    given), batches holding a benchmark named in `server.refuse` get a
+    400, and posts to any other path get a 404.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        entries = json.loads(urlparse.parse_qs(body)['json'][0])
+        server.requests.append((self.path, len(entries)))
+        server.connections.add(self.client_address)
+        if self.path != '/result/add/json/':
+            status, text = 404, 'Not Found'
+        elif server.failures:
+            server.failures -= 1
+            status, text = server.failure_status, 'Try again later'
+        elif [e for e in entries if e['benchmark'] in server.refuse]:
+            status, text = 400, 'Unknown benchmark'
+        else:
+            status, text = 202, 'All result data saved successfully'
+            server.saved.extend(entries)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+def stand_in_server(failures=0, refuse=(), port=0, failure_status=503):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), StandInCodespeed)
+    server.failures = failures
+    server.failure_status = failure_status
+    server.refuse = set(refuse)
+    server.requests = []
+    server.connections = set()
+    server.saved = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+def server_url(server):
+    return 'http://127.0.0.1:%d/' % server.server_address[1]
+
+def spool_entries(workdir, names):
+    spool = Spool(os.path.join(workdir, 'spool.db'))
+    spool.add([{'benchmark': name, 'result_value': 1.0} for name in names])
+    return spool
+
+def check_upload_retries_5xx(workdir):
+    server = stand_in_server(failures=2)
+    spool = spool_entries(workdir, ['b%d' % i for i in range(250)])
+    delays = []
+    uploader = Uploader(server_url(server), retries=3, backoff=1.0, sleep=delays.append)
+    try:
+        assert upload_spool(spool, uploader, batch_size=100) == 250
+    finally:
+        uploader.close()
+        stop_server(server)
+    assert spool.count() == 0
+    assert len(server.saved) == 250
+    assert [n for path, n in server.requests] == [100, 100, 100, 100, 50], server.requests
+    assert set(path for path, n in server.requests) == set(['/result/add/json/'])
+    assert delays == [1.0, 2.0], delays
+    # a new connection after each 503, then one for all the batches
+    assert len(server.connections) == 3, server.connections
+    spool.close()
+
+def check_upload_retries_429(workdir):
+    server = stand_in_server(failures=2, failure_status=429)
+    spool = spool_entries(workdir, ['b%d' % i for i in range(5)])
+    delays = []
+    uploader = Uploader(server_url(server), retries=3, backoff=1.0, sleep=delays.append)
+    try:
+        assert upload_spool(spool, uploader) == 5
+    finally:
+        uploader.close()
+        stop_server(server)
+    assert spool.count() == 0
+    assert len(server.saved) == 5
+    assert delays == [1.0, 2.0], delays
+    assert not spool.db.execute('SELECT * FROM spool').fetchall()
+    spool.close()
+
+def check_upload_stops_on_404(workdir):
+    # a wrong --url is not bad data: nothing may be set aside as rejected
+    server = stand_in_server()
+    spool = spool_entries(workdir, ['b%d' % i for i in range(20)])
+    delays = []
+    uploader = Uploader(server_url(server) + 'not-codespeed/', retries=3,
+                        sleep=delays.append)
+    try:
+        assert upload_spool(spool, uploader, batch_size=10) == 0
+    finally:
+        uploader.close()
+        stop_server(server)
+    # one request, no retries, no splitting
+    assert [n for path, n in server.requests] == [10], server.requests
+    assert delays == [], delays
+    assert spool.count() == 20
+    rejected = spool.db.execute('SELECT * FROM spool WHERE rejected IS NOT NULL').fetchall()
+    assert rejected == [], rejected
+    spool.close()
+
+def check_upload_splits_on_4xx(workdir):
+    server = stand_in_server(refuse=['bad'])
+    names = ['b%d' % i for i in range(20)]
+    names.insert(13, 'bad')
+    spool = spool_entries(workdir, names)
+    uploader = Uploader(server_url(server), retries=0)
+    try:
+        assert upload_spool(spool, uploader, batch_size=100) == 20
+    finally:
+        uploader.close()
+        stop_server(server)
+    assert sorted(e['benchmark'] for e in server.saved) == sorted(n for n in names if n != 'bad')
+    assert spool.count() == 0
+    rejected = spool.db.execute('SELECT entry, rejected FROM spool').fetchall()
+    assert len(rejected) == 1 and 'bad' in rejected[0][0] and '400' in rejected[0][1], rejected
+    assert len(server.connections) == 1, server.connections
+    spool.close()
+
+def check_upload_keeps_spool_while_down(workdir):
+    # find a free port, then upload to it with nothing listening
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    spool = spool_entries(workdir, ['b%d' % i for i in range(5)])
+    delays = []
+    uploader = Uploader('http://127.0.0.1:%d/' % port, retries=2, sleep=delays.append)
+    assert upload_spool(spool, uploader) == 0
+    uploader.close()
+    assert spool.count() == 5
+    assert len(delays) == 2, delays
+    server = stand_in_server(port=port)
+    uploader = Uploader(server_url(server), retries=0)
+    try:
+        assert upload_spool(spool, uploader) == 5
+    finally:
+        uploader.close()
+        stop_server(server)
+    assert spool.count() == 0
+    spool.close()
+
+CHECKS = [
+    check_steady_state_with_plugin,
+    check_upload_retries_5xx,
+    check_upload_retries_429,
+    check_upload_stops_on_404,
+    check_upload_splits_on_4xx,
+    check_upload_keeps_spool_while_down,
+]
+
+def main(names):
+    failed = 0
+    for check in CHECKS:
+        if names and check.__name__ not in names:
+            continue
+        workdir = tempfile.mkdtemp(prefix='check-speedcenter-')
+        try:
+            check(workdir)
+        except AssertionError as e:
+            failed += 1
+            print 'FAIL: %s: %s' % (check.__name__, e)
+        else:
+            print 'ok: %s' % check.__name__
+        finally:
+            shutil.rmtree(workdir)
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Self-checks for syrupy.py and its helpers that run without an agent.
+
+    python contrib/codespeed/check_syrupy.py [CHECK ...]
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import syrupy
+import sample_store
+
+def drive_leak_detector(interval, growth_kb_per_second, hours=3):
+    detector = syrupy.LeakDetector(threshold=1024 * 1024, window=3600, warmup=300)
+    t = 0.0
+    while t <= hours * 3600:
+        detector.add(1000000 + t, 50000 + growth_kb_per_second * t)
+        t += interval
+    return detector.verdict()
+
+def check_leak_detector_coarse_intervals(workdir):
+    # the verdict must not depend on how often RSS was sampled
+    for interval in (0.5, 1, 7, 10, 60, 300):
+        verdict = drive_leak_detector(interval, 10)
+        assert verdict['window_status'] == 'leak', (interval, verdict)
+        assert verdict['status'] == 'leak', (interval, verdict)
+        assert verdict['span_seconds'] >= 3600, (interval, verdict)
+        verdict = drive_leak_detector(interval, 0)
+        assert verdict['status'] == 'ok', (interval, verdict)
+
+def write_store(path, rows, capacity=0):
+    writer = sample_store.ColumnWriter(path, capacity=capacity, block_rows=7)
+    for i in range(rows):
+        writer.append((1000.0 + i, 42, 1.5, 0.5, 5000 + i, 9000))
+    writer.close()
+
+def check_column_reader_outlives_segments(workdir):
+    # whatever the reader hands out must not pin the map, so that
+    # closing it does not raise, and must stay readable afterwards
+    for capacity in (0, 16):
+        path = os.path.join(workdir, 'store-%d' % capacity)
+        write_store(path, 40, capacity)
+        with sample_store.ColumnReader(path) as reader:
+            segments = list(reader.segments('rss'))
+            column = reader.column('rss')
+        expected = list(range(5000, 5040))[-capacity:]
+        assert [v for segment in segments for v in segment] == expected, (capacity, segments)
+        assert list(column) == expected, (capacity, column)
+
+def check_unique_labels(workdir):
+    # 'a b' and 'a/b' both become 'a_b'; the second must not take the
+    # label of the pattern given as 'a_b_2'
+    targets = syrupy.unique_labels([
+        syrupy.Target(label=syrupy.target_label(command_pattern=pattern),
+                      command_pattern=pattern)
+        for pattern in ('a b', 'a/b', 'a_b_2', 'a b')])
+    labels = [target.label for target in targets]
+    assert labels == ['a_b', 'a_b_3', 'a_b_2', 'a_b_4'], labels
+    if sys.version_info >= (3, 7):
+        import syrupy_aio
+        labels = [target.label for target in syrupy_aio._targets([7, 7], ['x y', 'x/y'])]
+        assert labels == ['pid7', 'pid7_2', 'x_y', 'x_y_2'], labels
+
+CHECKS = [
+    check_leak_detector_coarse_intervals,
+    check_column_reader_outlives_segments,
+    check_unique_labels,
+]
+
+def main(names):
+    failed = 0
+    for check in CHECKS:
+        if names and check.__name__ not in names:
+            continue
+        workdir = tempfile.mkdtemp(prefix='check-syrupy-')
+        try:
+            check(workdir)
+        except AssertionError as e:
+            failed += 1
+            sys.stdout.write('FAIL: %s: %s\n' % (check.__name__, e))
+        else:
+            sys.stdout.write('ok: %s\n' % check.__name__)
+        finally:
+            shutil.rmtree(workdir)
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,16 +3,24 @@ import sys
 import re
 import json
 import urllib
-import urllib2
+import urlparse
+import httplib
+import socket
 import time
 import datetime
 import os
 import csv
+import select
+import signal
+import sqlite3
+import collections
 
 import subprocess as sub
 
 from optparse import OptionParser
 
+from syrupy import P2Quantile, RunningStats, monotonic, student_t_sf, student_t_ppf
+
 CODESPEED_URL = ''
 
 PROJECT = 'virgo'
@@ -21,10 +29,354 @@ ENVIRONMENT = 'virgo buildbot'
 BUILDER_NAME = 'virgo-ubuntu10.04_x86_64'
 
 SLEEP_SECONDS = 60 * 60
+WARMUP_SECONDS = 5 * 60
+CONFIDENCE = 0.95
+
+# exit status when a benchmark regressed against the baseline
+REGRESSION_EXIT_STATUS = 2
 
+# syrupy writes agent samples to stdout and, with --tree, the totals for
+# the agent and its plugins to stderr; the agent's own output goes to
+# TITLE.out.log and TITLE.err.log
+TITLE = 'virgo-memory'
 COMMAND = '%s ' + \
-          '--separator=, -N -t ' + \
-          'virgo-memory --no-align -r -S --flush-output %s %s'
+          '--separator=, -t ' + \
+          TITLE + ' --no-align -r -S --flush-output --tree --no-summary %s %s'
+AGENT_LOGS = [TITLE + '.out.log', TITLE + '.err.log']
+CHECKPOINT = TITLE + '.partial.json'
+CHECKPOINT_SECONDS = 60
+
+# results wait here until Codespeed has accepted them
+SPOOL = 'codespeed-spool.db'
+BATCH_SIZE = 100
+
+class Benchmark(object):
+    """
+    A named measurement taken from one agent run. Subclasses set the
+    Codespeed metadata and override the hooks they need: `sample` gets
+    each syrupy row of the agent process, `tree` each row of totals for
+    the agent and its plugins (rows carry the seconds since launch as
+    'elapsed'), and `log` each line the agent logs with the seconds since
+    launch. `result` returns the value, or None if the
+    run did not produce one.
+    """
+    key = None
+    name = None
+    units = ''
+    units_title = ''
+    lessisbetter = True
+
+    def __init__(self, options):
+        self.options = options
+
+    def sample(self, row):
+        pass
+
+    def tree(self, row):
+        pass
+
+    def log(self, elapsed, line):
+        pass
+
+    def result(self):
+        return None
+
+    def extra(self):
+        # additional Codespeed fields (std_dev, min, max)
+        return {}
+
+    def done(self):
+        # True to end the run before its time is up
+        return False
+
+class PeakMemory(Benchmark):
+    key = 'peak-rss'
+    name = 'virgo peak memory usage'
+    units = 'KB'
+    units_title = 'Memory'
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.peak = None
+
+    def sample(self, row):
+        rss = float(row['RSS'])
+        if self.peak is None or rss > self.peak:
+            self.peak = rss
+
+    def result(self):
+        return self.peak
+
+class SteadyMemory(Benchmark):
+    """
+    Mean RSS of the agent once the warmup period is over or, when runs
+    end at steady state, over the last steady-state window.
+    """
+    key = 'steady-rss'
+    name = 'virgo steady-state memory usage'
+    units = 'KB'
+    units_title = 'Memory'
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.stats = RunningStats()
+        self.window = options.steady_window and WindowBand(options.steady_window)
+
+    def sample(self, row):
+        if self.window:
+            self.window.add(row['elapsed'], float(row['RSS']))
+        elif row['elapsed'] >= float(self.options.warmup):
+            self.stats.add(float(row['RSS']))
+
+    def result(self):
+        if self.window:
+            return self.window.mean()
+        return self.stats.count and self.stats.mean or None
+
+    def extra(self):
+        if self.window:
+            if self.window.mean() is None:
+                return {}
+            return {'min': self.window.min(), 'max': self.window.max()}
+        return {'std_dev': self.stats.stddev(), 'min': self.stats.min, 'max': self.stats.max}
+
+class CpuP95(Benchmark):
+    """
+    95th percentile of the CPU used by the agent and its plugins over each
+    polling interval.
+    """
+    key = 'cpu-p95'
+    name = 'virgo p95 cpu usage'
+    units = '%'
+    units_title = 'CPU'
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.quantile = P2Quantile(0.95)
+
+    def tree(self, row):
+        self.quantile.add(float(row['CPU']))
+
+    def result(self):
+        return self.quantile.value()
+
+class LogMarker(Benchmark):
+    """
+    Seconds from launch until the agent first logs a line matching
+    `pattern` (any line if None).
+    """
+    units = 's'
+    units_title = 'Time'
+    pattern = None
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.elapsed = None
+
+    def log(self, elapsed, line):
+        if self.elapsed is None and (self.pattern is None or re.search(self.pattern, line)):
+            self.elapsed = elapsed
+
+    def result(self):
+        return self.elapsed
+
+class StartupTime(LogMarker):
+    key = 'startup'
+    name = 'virgo startup time'
+
+class HandshakeTime(LogMarker):
+    # logged at debug level: run the agent with -d
+    key = 'handshake'
+    name = 'virgo time to handshake'
+    pattern = r'handshake successful'
+
+class HeartbeatLatency(Benchmark):
+    # logged at debug level: run the agent with -d
+    key = 'heartbeat'
+    name = 'virgo heartbeat latency'
+    units = 'ms'
+    units_title = 'Time'
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.stats = RunningStats()
+
+    def log(self, elapsed, line):
+        match = re.search(r'Got pong \(latency=([0-9.]+)', line)
+        if match:
+            self.stats.add(float(match.group(1)))
+
+    def result(self):
+        return self.stats.count and self.stats.mean or None
+
+    def extra(self):
+        return {'std_dev': self.stats.stddev(), 'min': self.stats.min, 'max': self.stats.max}
+
+class WindowBand(object):
+    """
+    Minimum, maximum and mean of the values added in the last `window`
+    seconds, kept in monotonic queues so each value costs O(1).
+    """
+
+    def __init__(self, window):
+        self.window = float(window)
+        self.values = collections.deque()
+        self.lows = collections.deque()
+        self.highs = collections.deque()
+        self.total = 0.0
+
+    def add(self, t, x):
+        entry = (t, x)
+        self.values.append(entry)
+        self.total += x
+        while self.lows and self.lows[-1][1] >= x:
+            self.lows.pop()
+        self.lows.append(entry)
+        while self.highs and self.highs[-1][1] <= x:
+            self.highs.pop()
+        self.highs.append(entry)
+        # keep one value at or before the start of the window, so that
+        # covers() can tell whether the whole window has been seen
+        while len(self.values) > 1 and self.values[1][0] <= t - self.window:
+            old = self.values.popleft()
+            self.total -= old[1]
+            for queue in (self.lows, self.highs):
+                if queue[0] is old:
+                    queue.popleft()
+
+    def start(self):
+        return self.values[0][0]
+
+    def covers(self, t):
+        return bool(self.values) and self.values[0][0] <= t - self.window
+
+    def min(self):
+        return self.lows[0][1]
+
+    def max(self):
+        return self.highs[0][1]
+
+    def mean(self):
+        if not self.values:
+            return None
+        return self.total / len(self.values)
+
+class SteadyState(Benchmark):
+    """
+    Seconds from launch until the agent settled: the start of the first
+    window of --steady-window seconds in which its RSS stayed within
+    --rss-tolerance (relative) and the CPU of the agent and its plugins
+    within --cpu-tolerance (percentage points). Ends the run once found.
+    """
+    key = 'steady-state'
+    name = 'virgo time to steady state'
+    units = 's'
+    units_title = 'Time'
+
+    def __init__(self, options):
+        Benchmark.__init__(self, options)
+        self.rss = None
+        self.cpu = None
+        if options.steady_window:
+            self.rss = WindowBand(options.steady_window)
+            self.cpu = WindowBand(options.steady_window)
+        self.converged = None
+        self.detected = None
+
+    def sample(self, row):
+        if self.rss is not None and self.converged is None:
+            self.rss.add(row['elapsed'], float(row['RSS']))
+            self.check(row['elapsed'])
+
+    def tree(self, row):
+        if self.cpu is not None and self.converged is None:
+            self.cpu.add(row['elapsed'], float(row['CPU']))
+            self.check(row['elapsed'])
+
+    def check(self, t):
+        if not (self.rss.covers(t) and self.cpu.covers(t)):
+            return
+        if self.rss.max() - self.rss.min() > self.options.rss_tolerance * self.rss.mean():
+            return
+        if self.cpu.max() - self.cpu.min() > self.options.cpu_tolerance:
+            return
+        self.converged = max(self.rss.start(), self.cpu.start())
+        self.detected = t
+        print "STEADY: after %.1fs (detected at %.1fs)" % (self.converged, self.detected)
+
+    def done(self):
+        return self.converged is not None
+
+    def result(self):
+        return self.converged
+
+BENCHMARKS = [PeakMemory, SteadyMemory, CpuP95, StartupTime, HandshakeTime, HeartbeatLatency,
+              SteadyState]
+
+class LineReader(object):
+    """
+    Splits data read in arbitrary chunks into complete lines.
+    """
+
+    def __init__(self):
+        self.partial = ''
+
+    def feed(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+class LogTail(object):
+    """
+    Follows a log file that may not exist yet, returning new lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.reader = LineReader()
+
+    def lines(self):
+        if self.fd is None:
+            if not os.path.exists(self.path):
+                return []
+            self.fd = os.open(self.path, os.O_RDONLY)
+        lines = []
+        while True:
+            # os.read, unlike file.read, keeps returning data written
+            # after it has once reached the end of the file
+            data = os.read(self.fd, 65536)
+            if not data:
+                return lines
+            lines.extend(self.reader.feed(data))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+class SyrupyRows(object):
+    """
+    Parses syrupy's comma-separated output, one line at a time, into
+    dictionaries keyed by the column headers.
+    """
+
+    def __init__(self, first_column):
+        self.first_column = first_column
+        self.header = None
+
+    def parse(self, line):
+        if not line or line.startswith('SYRUPY:'):
+            return None
+        fields = next(csv.reader([line]))
+        if fields[0] == self.first_column:
+            self.header = fields
+            return None
+        if self.header is None or len(fields) != len(self.header):
+            return None
+        row = dict(zip(self.header, fields))
+        stamp = time.strptime(row['DATE'] + ' ' + row['TIME'].split('.')[0], '%Y-%m-%d %H:%M:%S')
+        row['epoch'] = time.mktime(stamp)
+        return row
 
 def get_revision(options):
     version_run = "%s --version" % options.executable
@@ -37,76 +389,530 @@ def get_revision(options):
     if (len(errors)):
         print(errors)
 
-    return REVISION
+    return REVISION.strip()
+
+class Spool(object):
+    """
+    Durable queue of Codespeed result entries in SQLite. Entries stay
+    until the server accepts them; ones it rejects outright are kept,
+    with its response, but no longer sent.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                        'id INTEGER PRIMARY KEY, entry TEXT, queued TEXT, '
+                        'attempts INTEGER DEFAULT 0, rejected TEXT)')
+
+    def add(self, entries):
+        queued = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.db:
+            self.db.executemany('INSERT INTO spool (entry, queued) VALUES (?, ?)',
+                                [(json.dumps(entry, sort_keys=True), queued)
+                                 for entry in entries])
+
+    def pending(self, limit):
+        return [(row[0], json.loads(row[1])) for row in self.db.execute(
+            'SELECT id, entry FROM spool WHERE rejected IS NULL ORDER BY id LIMIT ?',
+            (limit,))]
 
-def send_to_codespeed(url, data):
-    response = 'None'
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM spool '
+                               'WHERE rejected IS NULL').fetchone()[0]
 
+    def attempted(self, ids):
+        with self.db:
+            self.db.executemany('UPDATE spool SET attempts = attempts + 1 WHERE id = ?',
+                                [(id,) for id in ids])
+
+    def remove(self, ids):
+        with self.db:
+            self.db.executemany('DELETE FROM spool WHERE id = ?', [(id,) for id in ids])
+
+    def reject(self, ids, response):
+        with self.db:
+            self.db.executemany('UPDATE spool SET rejected = ? WHERE id = ?',
+                                [(response, id) for id in ids])
+
+    def close(self):
+        self.db.close()
+
+# responses that mean the data itself was refused; anything else from
+# the 4xx range (a wrong URL, missing credentials) stops the upload
+REJECTED = (400, 422)
+# responses that only ask us to come back later
+RETRIED = (408, 429)
+
+class UploadError(Exception):
+    def __init__(self, message, permanent=False):
+        Exception.__init__(self, message)
+        self.permanent = permanent
+
+class Uploader(object):
+    """
+    Posts batches of entries to Codespeed's result/add/json/ over one
+    kept-alive HTTP(S) connection, reconnecting after errors. Connection
+    errors, 408, 429 and 5xx responses are retried `retries` times,
+    waiting `backoff` seconds and doubling up to `max_backoff`.
+    """
+
+    def __init__(self, url, retries=5, backoff=1.0, max_backoff=60.0, timeout=30.0,
+                 sleep=time.sleep):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parts.netloc
+        self.path = parts.path.rstrip('/') + '/result/add/json/'
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.connection = None
+
+    def _post(self, body):
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        self.connection.request('POST', self.path, body, {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive',
+        })
+        response = self.connection.getresponse()
+        # the response must be read before the connection can be reused
+        return response.status, response.read()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send(self, entries):
+        """
+        Posts `entries` as one request and returns the server's response,
+        or raises UploadError once the retries are used up, or at once for
+        any other 4xx. The error is permanent if the server rejected the
+        data itself (400, 422).
+        """
+        body = urllib.urlencode({'json': json.dumps(entries)})
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                status, response = self._post(body)
+            except (socket.error, httplib.HTTPException) as e:
+                self.close()
+                error = 'connection to %s failed: %s' % (self.netloc, e)
+            else:
+                if 200 <= status < 300:
+                    return response
+                if status in REJECTED:
+                    raise UploadError('HTTP %d: %s' % (status, response), permanent=True)
+                if 400 <= status < 500 and status not in RETRIED:
+                    raise UploadError('HTTP %d: %s' % (status, response))
+                self.close()
+                error = 'HTTP %d: %s' % (status, response)
+            if attempt < self.retries:
+                print "WARNING: upload failed (%s), retrying in %gs" % (error, delay)
+                self.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        raise UploadError(error)
+
+def deliver(spool, uploader, batch):
+    """
+    Sends one batch of spooled (id, entry) pairs. A batch the server
+    rejects is split in halves and retried, so that only the entries it
+    objects to are set aside. Returns the number uploaded; raises
+    UploadError if the server could not be reached or refused the
+    request for another reason.
+    """
+    ids = [id for id, entry in batch]
+    spool.attempted(ids)
     try:
-        f = urllib2.urlopen(url + 'result/add/json/', urllib.urlencode(data))
-    except urllib2.HTTPError, error:
-        print error.read()
-        return
+        response = uploader.send([entry for id, entry in batch])
+    except UploadError as e:
+        if not e.permanent:
+            raise
+        if len(batch) == 1:
+            print "ERROR: result rejected: %s" % e
+            spool.reject(ids, str(e))
+            return 0
+        half = len(batch) // 2
+        return deliver(spool, uploader, batch[:half]) + deliver(spool, uploader, batch[half:])
+    spool.remove(ids)
+    print 'Server (%s) response: %s\n' % (uploader.netloc, response)
+    return len(ids)
 
-    response = f.read()
-    f.close()
-    print 'Server (%s) response: %s\n' % (url, response)
+def upload_spool(spool, uploader, batch_size=BATCH_SIZE):
+    """
+    Sends everything spooled, `batch_size` entries per request. Stops at
+    the first batch that cannot be delivered, leaving it spooled for the
+    next attempt. Returns the number of entries uploaded.
+    """
+    uploaded = 0
+    while True:
+        batch = spool.pending(batch_size)
+        if not batch:
+            return uploaded
+        try:
+            uploaded += deliver(spool, uploader, batch)
+        except UploadError as e:
+            print "ERROR: upload failed, %d results left in the spool: %s" % (spool.count(), e)
+            return uploaded
 
+def upload(options):
+    """
+    Uploads the spooled results to `options.url`. Returns True if
+    nothing is left to send.
+    """
+    spool = Spool(options.spool)
+    uploader = Uploader(options.url, retries=options.retries, backoff=options.backoff)
+    try:
+        upload_spool(spool, uploader, options.batch_size)
+        return spool.count() == 0
+    finally:
+        uploader.close()
+        spool.close()
 
-def main(options):
-    payload = {'json': []}
-    props = {}
-    benchmark = 'virgo peak memory usage'
-    syrupy = os.path.join('.', os.path.dirname(sys.argv[0]), 'syrupy.py')
-    command = COMMAND % (syrupy, options.executable, options.options)
-    revision = get_revision(options)
+class Checkpoint(object):
+    """
+    Keeps the results so far -- the values of finished trials and those
+    of the running one -- in a JSON file, rewritten atomically, so that
+    they outlive an agent that dies early or a harness that is killed.
+    """
+
+    def __init__(self, path, options, revision, results):
+        self.path = path
+        self.interval = options.checkpoint_interval
+        self.header = {'revision': revision, 'environment': options.environment,
+                       'executable': options.executable}
+        self.results = results
+        self.trial = None
+        self.benchmarks = []
+        self.saved = None
+
+    def start_trial(self, trial, warmup, benchmarks):
+        self.trial = {'trial': trial, 'warmup': warmup}
+        self.benchmarks = benchmarks
+
+    def due(self, now):
+        return self.saved is None or now - self.saved >= self.interval
+
+    def save(self, status, elapsed=None):
+        if not self.path:
+            return
+        state = dict(self.header)
+        state.update({'status': status,
+                      'updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                      'benchmarks': {}})
+        for cls, values in self.results.items():
+            state['benchmarks'][cls.name] = {'units': cls.units, 'lessisbetter': cls.lessisbetter,
+                                             'trials': values}
+        if self.trial is not None and status != 'complete':
+            state['current'] = dict(self.trial, elapsed=elapsed)
+            for benchmark in self.benchmarks:
+                entry = state['benchmarks'].setdefault(benchmark.name, {'trials': []})
+                entry['current'] = benchmark.result()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(state, fp, indent=2, sort_keys=True, separators=(',', ': '))
+            fp.write('\n')
+        os.rename(tmp, self.path)
+        self.saved = monotonic()
+
+def interrupted(signum, frame):
+    # SIGTERM from a CI timeout is handled like Ctrl-C
+    raise KeyboardInterrupt()
 
+def run_agent(command, seconds, benchmarks, checkpoint=None):
+    """
+    Runs syrupy (and through it the agent) for `seconds`, or until a
+    benchmark is done, feeding its samples and the agent's log lines to
+    `benchmarks` as they arrive and saving `checkpoint` as it goes.
+    Returns False if syrupy could not be started or stopped early.
+    """
+    for path in AGENT_LOGS:
+        if os.path.exists(path):
+            os.remove(path)
     try:
-        p = sub.Popen(command.split(), stdout=sub.PIPE, stderr=sub.PIPE)
+        # a process group of its own, so the agent is stopped with syrupy
+        p = sub.Popen(command.split(), stdout=sub.PIPE, stderr=sub.PIPE,
+                      preexec_fn=os.setsid)
     except OSError as e:
         print "ERROR: running: %s" % command
-        return
+        return False
+    start = monotonic()
+    deadline = start + float(seconds)
+    samples = SyrupyRows('PID')
+    totals = SyrupyRows('ROOT')
+    readers = {p.stdout: (LineReader(), samples), p.stderr: (LineReader(), totals)}
+    tails = [LogTail(path) for path in AGENT_LOGS]
+    early = False
+    # with --tree syrupy lists every process of the tree, the agent
+    # first; only the agent's own rows are samples
+    agent_pid = None
+
+    try:
+        while True:
+            now = monotonic()
+            for tail in tails:
+                for line in tail.lines():
+                    for benchmark in benchmarks:
+                        benchmark.log(now - start, line)
+            if checkpoint is not None and checkpoint.due(now):
+                checkpoint.save('running', now - start)
+            if now >= deadline or any(benchmark.done() for benchmark in benchmarks):
+                break
+            if not readers:
+                early = True
+                break
+            ready = select.select(list(readers), [], [], min(0.1, deadline - now))[0]
+            for stream in ready:
+                data = os.read(stream.fileno(), 65536)
+                if not data:
+                    del readers[stream]
+                    continue
+                reader, rows = readers[stream]
+                for line in reader.feed(data):
+                    row = rows.parse(line)
+                    if row is None:
+                        continue
+                    if rows is samples:
+                        if agent_pid is None:
+                            agent_pid = row['PID']
+                        if row['PID'] != agent_pid:
+                            continue
+                    row['elapsed'] = monotonic() - start
+                    for benchmark in benchmarks:
+                        if rows is samples:
+                            benchmark.sample(row)
+                        else:
+                            benchmark.tree(row)
+    finally:
+        # stop the agent however the loop ended
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        p.stdout.close()
+        p.stderr.close()
+        p.wait()
+        for tail in tails:
+            tail.close()
+    if early:
+        print "ERROR: died early after %.1fs: %s" % (monotonic() - start, command)
+        if checkpoint is not None:
+            checkpoint.save('agent died', monotonic() - start)
+        return False
+    return True
+
+def summarize_trials(values, confidence):
+    """
+    Mean, median, standard deviation and the `confidence` interval of the
+    mean (Student's t) of the values from several trials.
+    """
+    n = len(values)
+    ordered = sorted(values)
+    mean = sum(values) / float(n)
+    median = (ordered[(n - 1) // 2] + ordered[n // 2]) / 2.0
+    stddev = 0.0
+    half_width = None
+    if n > 1:
+        stddev = (sum((x - mean) ** 2 for x in values) / (n - 1)) ** 0.5
+        half_width = student_t_ppf(0.5 + confidence / 2.0, n - 1) * stddev / n ** 0.5
+    return {'n': n, 'mean': mean, 'median': median, 'stddev': stddev,
+            'min': ordered[0], 'max': ordered[-1], 'ci': half_width}
+
+def welch_test(new, old, lessisbetter):
+    """
+    One-sided Welch t-test of whether the `new` values are worse than the
+    `old` ones (higher if `lessisbetter`, lower otherwise). Returns the
+    p-value, or None without two values on each side.
+    """
+    if len(new) < 2 or len(old) < 2:
+        return None
+    a = summarize_trials(new, CONFIDENCE)
+    b = summarize_trials(old, CONFIDENCE)
+    diff = a['mean'] - b['mean']
+    if not lessisbetter:
+        diff = -diff
+    va = a['stddev'] ** 2 / a['n']
+    vb = b['stddev'] ** 2 / b['n']
+    if va + vb == 0:
+        return diff > 0 and 0.0 or 1.0
+    dof = (va + vb) ** 2 / (va ** 2 / (a['n'] - 1) + vb ** 2 / (b['n'] - 1))
+    return student_t_sf(diff / (va + vb) ** 0.5, dof)
+
+class Baseline(object):
+    """
+    Local store of per-trial results in SQLite, keyed by revision, so that
+    a run can be checked against an earlier one without Codespeed.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'revision TEXT, environment TEXT, benchmark TEXT, '
+                        'trial INTEGER, value REAL, recorded TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_key '
+                        'ON results (environment, benchmark, revision)')
 
-    time.sleep(float(options.sleep))
+    def previous_revision(self, environment, revision):
+        # the most recently recorded revision other than this one
+        row = self.db.execute('SELECT revision FROM results '
+                              'WHERE environment = ? AND revision != ? '
+                              'ORDER BY recorded DESC LIMIT 1',
+                              (environment, revision)).fetchone()
+        return row and row[0] or None
 
+    def values(self, environment, revision, benchmark):
+        return [row[0] for row in self.db.execute(
+            'SELECT value FROM results '
+            'WHERE environment = ? AND revision = ? AND benchmark = ? ORDER BY trial',
+            (environment, revision, benchmark))]
+
+    def record(self, environment, revision, benchmark, values, recorded):
+        with self.db:
+            self.db.execute('DELETE FROM results '
+                            'WHERE environment = ? AND revision = ? AND benchmark = ?',
+                            (environment, revision, benchmark))
+            self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                [(revision, environment, benchmark, trial, value, recorded)
+                                 for trial, value in enumerate(values)])
+
+    def close(self):
+        self.db.close()
+
+def check_regressions(baseline, options, revision, results, recorded):
+    """
+    Compares `results` ({benchmark class: values}) with the baseline
+    revision, prints the verdicts, then records `results` under
+    `revision`. Returns the names of the benchmarks that regressed.
+    """
+    previous = options.baseline_revision or \
+        baseline.previous_revision(options.environment, revision)
+    regressed = []
+    for cls in [cls for cls in BENCHMARKS if cls in results]:
+        values = results[cls]
+        old = previous and baseline.values(options.environment, previous, cls.name) or []
+        p = welch_test(values, old, cls.lessisbetter)
+        if p is None:
+            print "BASELINE: %s: nothing to compare with" % cls.name
+            continue
+        old_mean = sum(old) / len(old)
+        new_mean = sum(values) / len(values)
+        change = old_mean and (new_mean - old_mean) / abs(old_mean) or 0.0
+        worse = cls.lessisbetter and change > 0 or not cls.lessisbetter and change < 0
+        verdict = 'ok'
+        if p < options.alpha and worse and abs(change) >= options.min_change:
+            verdict = 'REGRESSION'
+            regressed.append(cls.name)
+        print "BASELINE: %s: %.4g -> %.4g %s (%+.1f%%, p=%.4f vs %s): %s" % (
+            cls.name, old_mean, new_mean, cls.units, change * 100, p, previous, verdict)
+    for cls, values in results.items():
+        baseline.record(options.environment, revision, cls.name, values, recorded)
+    return regressed
+
+def main(options):
+    if options.upload_only:
+        return not upload(options) and 1 or 0
+
+    payload = {'json': []}
+    syrupy_path = os.path.join('.', os.path.dirname(sys.argv[0]), 'syrupy.py')
+    command = COMMAND % (syrupy_path, options.executable, options.options)
+    revision = get_revision(options)
+
+    selected = options.benchmarks and options.benchmarks.split(',') or None
+    classes = [cls for cls in BENCHMARKS if selected is None or cls.key in selected]
+    # steady-state detection is what ends the runs early, so it always
+    # runs when asked for
+    if options.steady_window and SteadyState not in classes:
+        classes.append(SteadyState)
+    elif not options.steady_window and SteadyState in classes:
+        classes.remove(SteadyState)
+
+    # the first `warmup_trials` runs only warm caches and are discarded
+    results = dict((cls, []) for cls in classes)
+    extras = {}
+    checkpoint = Checkpoint(options.checkpoint, options, revision, results)
+    signal.signal(signal.SIGTERM, interrupted)
     try:
-        p.kill()
-    except OSError as e:
-        print e
-        print "ERROR: died early: %s" % command
-        return
-
-    output, errors = p.communicate()
-
-    # ['PID', 'DATE', 'TIME', 'ELAPSED', 'CPU', 'MEM', 'RSS', 'VSIZE']
-    csv_reader = csv.DictReader(output.split('\n'))
-
-    max_row = None
-    for row in csv_reader:
-        if max_row == None or max_row['RSS'] < row['RSS']:
-            max_row = row
-
-    date = max_row['DATE'] + ' ' + max_row['TIME']
-
-    entry = {
-        'commitid': revision,
-        'project': PROJECT,
-        'branch': BRANCH,
-        'executable': options.executable,
-        'benchmark': benchmark,
-        'environment': options.environment,
-        'result_value': float(max_row['RSS']),
-        'revision_date': date,
-        'result_date': date
-    }
-    payload['json'].append(entry)
+        for trial in range(options.warmup_trials + options.trials):
+            benchmarks = [cls(options) for cls in classes]
+            checkpoint.start_trial(trial, trial < options.warmup_trials, benchmarks)
+            if not run_agent(command, options.sleep, benchmarks, checkpoint):
+                if options.checkpoint:
+                    print "Partial results kept in %s" % options.checkpoint
+                return 1
+            if trial < options.warmup_trials:
+                continue
+            for benchmark in benchmarks:
+                value = benchmark.result()
+                if value is not None:
+                    results[benchmark.__class__].append(float(value))
+                    extras[benchmark.__class__] = benchmark.extra()
+    except KeyboardInterrupt:
+        checkpoint.save('interrupted')
+        print "Interrupted"
+        if options.checkpoint:
+            print "Partial results kept in %s" % options.checkpoint
+        return 1
+    checkpoint.save('complete')
+
+    date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for cls in classes:
+        values = results[cls]
+        if not values:
+            print "WARNING: no result for '%s'" % cls.name
+            del results[cls]
+            continue
+        stats = summarize_trials(values, options.confidence)
+        entry = {
+            'commitid': revision,
+            'project': PROJECT,
+            'branch': BRANCH,
+            'executable': options.executable,
+            'benchmark': cls.name,
+            'environment': options.environment,
+            'result_value': stats['mean'],
+            'units': cls.units,
+            'units_title': cls.units_title,
+            'lessisbetter': cls.lessisbetter,
+            'revision_date': date,
+            'result_date': date
+        }
+        if stats['n'] > 1:
+            # spread across trials rather than within one
+            entry.update({'std_dev': stats['stddev'], 'min': stats['min'], 'max': stats['max']})
+            print "%s: mean %.4g, median %.4g, %g%% CI +/- %.4g %s (%d trials)" % (
+                cls.name, stats['mean'], stats['median'], options.confidence * 100,
+                stats['ci'], cls.units, stats['n'])
+        else:
+            for key, extra in extras[cls].items():
+                if extra is not None:
+                    entry[key] = extra
+        payload['json'].append(entry)
 
     print(payload)
 
-    if len(payload['json']) > 0:
-        payload['json'] = json.dumps(payload['json'])
-        send_to_codespeed(options.url, payload)
+    # spooled first, so results outlive an unreachable server
+    if payload['json']:
+        spool = Spool(options.spool)
+        spool.add(payload['json'])
+        spool.close()
+    if options.url:
+        upload(options)
 
+    if options.baseline:
+        baseline = Baseline(options.baseline)
+        try:
+            regressed = check_regressions(baseline, options, revision, results, date)
+        finally:
+            baseline.close()
+        if regressed:
+            print "ERROR: regressed: %s" % ', '.join(regressed)
+            return REGRESSION_EXIT_STATUS
+    return 0
 
 if __name__ == '__main__':
     usage = 'usage: %prog'
@@ -120,9 +926,64 @@ if __name__ == '__main__':
     parser.add_option('--options', dest='options', default='',
                       help='Options to pass to the executable')
     parser.add_option('--sleep', dest='sleep', default=SLEEP_SECONDS,
-                      help='sleep in seconds')
+                      help='sleep in seconds (with --steady-window, the longest to wait)')
     parser.add_option('--environment', dest='environment', default=ENVIRONMENT,
                       help='Environment name')
+    parser.add_option('--warmup', dest='warmup', default=WARMUP_SECONDS,
+                      help='seconds of samples to ignore for steady-state results')
+    parser.add_option('--benchmarks', dest='benchmarks', default=None,
+                      help='comma-separated benchmarks to report, from: %s (default: all)'
+                           % ', '.join(cls.key for cls in BENCHMARKS))
+
+    parser.add_option('--steady-window', dest='steady_window', type='float', default=None,
+                      metavar='SECONDS',
+                      help='end each run once RSS and CPU have been steady for this long')
+    parser.add_option('--rss-tolerance', dest='rss_tolerance', type='float', default=0.02,
+                      help='steady RSS varies by at most this fraction of its mean '
+                           '(default=%default)')
+    parser.add_option('--cpu-tolerance', dest='cpu_tolerance', type='float', default=2.0,
+                      help='steady CPU varies by at most this many percentage points '
+                           '(default=%default)')
+    parser.add_option('--checkpoint', dest='checkpoint', default=CHECKPOINT, metavar='FILE',
+                      help='where to keep partial results while running; empty for '
+                           'none (default=%default)')
+    parser.add_option('--checkpoint-interval', dest='checkpoint_interval', type='float',
+                      default=CHECKPOINT_SECONDS,
+                      help='seconds between checkpoints (default=%default)')
+    parser.add_option('--spool', dest='spool', default=SPOOL, metavar='DB',
+                      help='SQLite file holding results until Codespeed accepts them '
+                           '(default=%default)')
+    parser.add_option('--upload-only', dest='upload_only', action='store_true', default=False,
+                      help="don't run the agent, just upload the spooled results")
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=BATCH_SIZE,
+                      help='results sent per request (default=%default)')
+    parser.add_option('--retries', dest='retries', type='int', default=5,
+                      help='times to retry a failed upload (default=%default)')
+    parser.add_option('--backoff', dest='backoff', type='float', default=1.0,
+                      help='seconds before the first retry, doubling after each '
+                           '(default=%default)')
+    parser.add_option('--trials', dest='trials', type='int', default=1,
+                      help='number of agent runs to report the mean of (default=%default)')
+    parser.add_option('--warmup-trials', dest='warmup_trials', type='int', default=0,
+                      help='number of agent runs to discard before the trials (default=%default)')
+    parser.add_option('--confidence', dest='confidence', type='float', default=CONFIDENCE,
+                      help='confidence level of the reported intervals (default=%default)')
+    parser.add_option('--baseline', dest='baseline', default=None, metavar='DB',
+                      help='SQLite file of earlier results to check for regressions '
+                           'against, and to record these results in; needs --trials 2 '
+                           'or more')
+    parser.add_option('--baseline-revision', dest='baseline_revision', default=None,
+                      help='revision to compare with (default: the last one recorded)')
+    parser.add_option('--alpha', dest='alpha', type='float', default=0.05,
+                      help='significance level of the regression test (default=%default)')
+    parser.add_option('--min-change', dest='min_change', type='float', default=0.0,
+                      help='smallest relative change counted as a regression, '
+                           'e.g. 0.05 for 5%% (default=%default)')
 
     (options, args) = parser.parse_args()
-    main(options)
+    if options.upload_only and not options.url:
+        parser.error('--upload-only needs --url')
+    if options.baseline and options.trials < 2:
+        # the t-test needs two values a side; one trial could never fail
+        parser.error('--baseline needs --trials 2 or more')
+    sys.exit(main(options))
@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+
+"""
+Compact columnar storage for syrupy samples.
+
+Instead of one formatted text line per sample, a store keeps fixed-width
+typed columns: time (f64, epoch seconds), pid (i32), cpu and mem (f32,
+percent), rss and vsz (i64, kB), then any extra metrics (i64, -1 when
+missing). Layout, little-endian:
+
+    header    '<4sHHQQ'  magic 'SYRC', version, column count,
+                         capacity, rows written
+    columns   '<16s2s'   name and type code (d, i, f or q) per column
+    data      append mode (capacity 0): blocks of a '<I' row count
+              followed by each column's values in turn;
+              ring mode: one region of `capacity` values per column,
+              row n going to slot n % capacity, so the file never grows
+              and only the latest `capacity` rows are kept.
+
+Usage:
+
+    python sample_store.py [--downsample N] STORE    # dump as text
+"""
+
+import os
+import sys
+import mmap
+import array
+import struct
+import time
+
+from optparse import OptionParser
+
+MAGIC = b'SYRC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ')
+COLUMN = struct.Struct('<16s2s')
+BLOCK = struct.Struct('<I')
+COUNT_OFFSET = 16
+
+COLUMNS = [
+    ('time', 'd'),
+    ('pid', 'i'),
+    ('cpu', 'f'),
+    ('mem', 'f'),
+    ('rss', 'q'),
+    ('vsz', 'q'),
+]
+
+def _array_code(code):
+    # the array module has no 'q' before Python 3.3; use whichever native
+    # code has the right width
+    size = struct.calcsize('<' + code)
+    for candidate in (code, 'i', 'l', 'q'):
+        try:
+            if array.array(candidate).itemsize == size:
+                return candidate
+        except ValueError:
+            pass
+    raise ValueError('no array type for %r' % code)
+
+def _to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def _from_bytes(code, data):
+    values = array.array(_array_code(code))
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+def record_row(pinfo, extra_columns=()):
+    """
+    Column values for a syrupy process record.
+    """
+    row = (pinfo['poll_epoch'], int(pinfo['pid']), float(pinfo['%cpu']),
+           float(pinfo['%mem']), int(pinfo['rss']), int(pinfo['vsz']))
+    if extra_columns:
+        row += tuple(pinfo[field] == '-' and -1 or int(pinfo[field]) for field in extra_columns)
+    return row
+
+class ColumnWriter(object):
+    """
+    Writes rows to a store. In append mode (`capacity` 0) rows are
+    buffered in typed arrays and written out `block_rows` at a time, or
+    once the oldest buffered row is `block_seconds` old, so that a
+    process killed outright loses little of a slow soak run. In
+    ring mode the file is preallocated for `capacity` rows and mapped,
+    and each row is written in place, overwriting the oldest.
+    `extra_columns` names further integer record fields to store.
+    """
+
+    def __init__(self, path, capacity=0, block_rows=1024, extra_columns=(),
+                 block_seconds=60):
+        self.path = path
+        self.capacity = capacity
+        self.block_rows = block_rows
+        self.block_seconds = block_seconds
+        self.block_started = None
+        self.count = 0
+        self.extra_columns = list(extra_columns)
+        columns = COLUMNS + [(name, 'q') for name in self.extra_columns]
+        self.codes = [code for name, code in columns]
+        self.structs = [struct.Struct('<' + code) for code in self.codes]
+        header = HEADER.pack(MAGIC, VERSION, len(columns), capacity, 0)
+        for name, code in columns:
+            header += COLUMN.pack(name.encode('ascii'), code.encode('ascii'))
+        self.data_offset = len(header)
+        self.fp = open(path, 'w+b')
+        self.fp.write(header)
+        if capacity:
+            self.offsets = []
+            offset = self.data_offset
+            for s in self.structs:
+                self.offsets.append(offset)
+                offset += s.size * capacity
+            self.fp.truncate(offset)
+            self.fp.flush()
+            self.map = mmap.mmap(self.fp.fileno(), offset)
+        else:
+            self.buffers = [array.array(_array_code(code)) for code in self.codes]
+
+    def append(self, row):
+        if self.capacity:
+            slot = self.count % self.capacity
+            for s, offset, value in zip(self.structs, self.offsets, row):
+                s.pack_into(self.map, offset + slot * s.size, value)
+            self.count += 1
+            struct.pack_into('<Q', self.map, COUNT_OFFSET, self.count)
+        else:
+            for values, value in zip(self.buffers, row):
+                values.append(value)
+            self.count += 1
+            now = time.time()
+            if self.block_started is None:
+                self.block_started = now
+            if len(self.buffers[0]) >= self.block_rows or \
+                    now - self.block_started >= self.block_seconds:
+                self._write_block()
+
+    def append_record(self, pinfo):
+        self.append(record_row(pinfo, self.extra_columns))
+
+    def _write_block(self):
+        rows = len(self.buffers[0])
+        self.block_started = None
+        if not rows:
+            return
+        self.fp.seek(0, os.SEEK_END)
+        self.fp.write(BLOCK.pack(rows))
+        for values in self.buffers:
+            self.fp.write(_to_bytes(values))
+            del values[:]
+        # the count is updated last, so readers never see a partial block
+        self.fp.seek(COUNT_OFFSET)
+        self.fp.write(struct.pack('<Q', self.count))
+        self.fp.flush()
+
+    def flush(self):
+        if self.capacity:
+            self.map.flush()
+        else:
+            self._write_block()
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.flush()
+        if self.capacity:
+            self.map.close()
+        self.fp.close()
+        self.fp = None
+
+class ColumnReader(object):
+    """
+    Reads a store through a read-only memory map. `segments(name)` yields
+    a column as contiguous runs in time order and `column(name)` joins
+    them into one array. Both return copies, so they stay valid after
+    `close()`; only `column()` reads the map through zero-copy views
+    (where `memoryview.cast` exists, Python 3), and it releases them
+    before returning, since the map cannot be closed while one is held.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ncols, self.capacity, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s: not a sample store' % path)
+        if version != VERSION:
+            raise ValueError('%s: unsupported store version %d' % (path, version))
+        self.columns = []
+        self.codes = {}
+        offset = HEADER.size
+        for idx in range(ncols):
+            name, code = COLUMN.unpack_from(self.map, offset)
+            name = name.rstrip(b'\0').decode('ascii')
+            self.columns.append(name)
+            self.codes[name] = code.rstrip(b'\0').decode('ascii')
+            offset += COLUMN.size
+        self.data_offset = offset
+        self.sizes = dict((name, struct.calcsize('<' + self.codes[name])) for name in self.columns)
+        if self.capacity:
+            self.rows = min(self.count, self.capacity)
+        else:
+            self.rows = self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    def _view(self, name, start, rows, copy=True):
+        size = self.sizes[name]
+        end = start + rows * size
+        if not copy and hasattr(memoryview, 'cast') and sys.byteorder == 'little':
+            return memoryview(self.map)[start:end].cast(_array_code(self.codes[name]))
+        return _from_bytes(self.codes[name], self.map[start:end])
+
+    def _ranges(self, name):
+        # (offset, rows) runs of the column, oldest first
+        if self.capacity:
+            offset = self.data_offset
+            for column in self.columns:
+                if column == name:
+                    break
+                offset += self.sizes[column] * self.capacity
+            size = self.sizes[name]
+            if self.count <= self.capacity:
+                return [(offset, self.rows)]
+            head = self.count % self.capacity
+            return [(offset + head * size, self.capacity - head), (offset, head)]
+        ranges = []
+        offset = self.data_offset
+        seen = 0
+        while seen < self.count:
+            rows = BLOCK.unpack_from(self.map, offset)[0]
+            offset += BLOCK.size
+            for column in self.columns:
+                if column == name:
+                    ranges.append((offset, rows))
+                offset += self.sizes[column] * rows
+            seen += rows
+        return ranges
+
+    def segments(self, name):
+        for offset, rows in self._ranges(name):
+            if rows:
+                yield self._view(name, offset, rows)
+
+    def column(self, name):
+        values = array.array(_array_code(self.codes[name]))
+        for offset, rows in self._ranges(name):
+            if rows:
+                segment = self._view(name, offset, rows, copy=False)
+                values.extend(segment)
+                if isinstance(segment, memoryview):
+                    segment.release()
+        return values
+
+    def downsample(self, name, buckets, pid=None):
+        """
+        Reduces column `name` to at most `buckets` (time, min, max)
+        points, keeping the extremes of each bucket so that spikes
+        survive plotting. If `pid` is given, only its rows are used.
+        """
+        times = self.column('time')
+        values = self.column(name)
+        if pid is not None:
+            pids = self.column('pid')
+            keep = [i for i in range(len(pids)) if pids[i] == pid]
+            times = [times[i] for i in keep]
+            values = [values[i] for i in keep]
+        points = []
+        n = len(values)
+        if not n:
+            return points
+        buckets = max(1, min(buckets, n))
+        for b in range(buckets):
+            lo = b * n // buckets
+            hi = (b + 1) * n // buckets
+            chunk = values[lo:hi]
+            points.append((times[lo], min(chunk), max(chunk)))
+        return points
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] STORE')
+    parser.add_option('--downsample', dest='downsample', type='int', default=None,
+                      metavar='N', help='print at most N (time, min, max) points per column')
+    parser.add_option('--pid', dest='pid', type='int', default=None,
+                      help='only rows for this PID')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+    with ColumnReader(args[0]) as reader:
+        if options.downsample:
+            for name in ('cpu', 'mem', 'rss', 'vsz'):
+                sys.stdout.write('# %s\n' % name)
+                for t, lo, hi in reader.downsample(name, options.downsample, options.pid):
+                    sys.stdout.write('%.3f\t%s\t%s\n' % (t, lo, hi))
+            return
+        columns = [reader.column(name) for name in reader.columns]
+        formats = {'d': '%.3f', 'f': '%.1f', 'i': '%d', 'q': '%d'}
+        row_format = '\t'.join(formats[reader.codes[name]] for name in reader.columns) + '\n'
+        sys.stdout.write('\t'.join(name.upper() for name in reader.columns) + '\n')
+        for row in zip(*columns):
+            if options.pid is not None and row[1] != options.pid:
+                continue
+            sys.stdout.write(row_format % row)
+
+if __name__ == '__main__':
+    main()
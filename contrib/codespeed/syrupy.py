@@ -33,6 +33,11 @@ import sys
 import os
 import datetime
 import textwrap
+import json
+import math
+import signal
+
+import sample_store
 
 PS_FIELDS = [
     'pid',
@@ -93,9 +98,111 @@ PS_FIELD_HELP = [
     process is currently using (in kiloBytes). This includes the amount
     in RAM (the resident set size) as well as the amount in swap."""
     ],
+    ["PROCS",
+    """
+    Tree mode only: the number of live processes in the tree rooted at
+    the tracked process when it was polled. The CPU, RSS and VSIZE
+    columns of a tree row are totals over these processes; its CPU is
+    the share of the last interval rather than the lifetime ratio."""
+    ],
+    ["SPAWNED",
+    """
+    Tree mode only: processes that joined the tree since the previous
+    poll."""
+    ],
+    ["EXITED",
+    """
+    Tree mode only: processes that left the tree since the previous
+    poll."""
+    ],
+    ["PSS",
+    """
+    '--metrics smaps' only: Proportional Set Size -- resident memory with
+    each shared page divided among the processes sharing it (in
+    kiloBytes)."""
+    ],
+    ["USS",
+    """
+    '--metrics smaps' only: Unique Set Size -- resident memory private to
+    the process, i.e. what would be freed if it exited (in kiloBytes)."""
+    ],
+    ["SWAP",
+    """
+    '--metrics smaps' only: memory of the process that is swapped out (in
+    kiloBytes)."""
+    ],
+    ["THREADS",
+    """
+    '--metrics status' only: number of threads in the process."""
+    ],
+    ["VCTX",
+    """
+    '--metrics status' only: voluntary context switches so far (the
+    process blocked, e.g. waiting for I/O)."""
+    ],
+    ["NVCTX",
+    """
+    '--metrics status' only: involuntary context switches so far (the
+    process was preempted)."""
+    ],
+    ["FDS",
+    """
+    '--metrics fd' only: number of open file descriptors, sockets
+    included."""
+    ],
+    ["RCHAR",
+    """
+    '--metrics io' only: bytes read so far through read-like system
+    calls, whether or not they reached the disk."""
+    ],
+    ["WCHAR",
+    """
+    '--metrics io' only: bytes written so far through write-like system
+    calls."""
+    ],
+    ["READ",
+    """
+    '--metrics io' only: bytes the process has caused to be fetched from
+    storage."""
+    ],
+    ["WRITE",
+    """
+    '--metrics io' only: bytes the process has caused to be sent to
+    storage."""
+    ],
+    ["TASKS",
+    """
+    '--metrics task' only: number of tasks (threads) listed under
+    /proc/<pid>/task."""
+    ],
+    ["RUNNING",
+    """
+    '--metrics task' only: tasks that were running or runnable when
+    polled."""
+    ],
+
+]
 
+# optional metric groups read from /proc: group -> [(column, field)]
+METRIC_GROUPS = [
+    ('smaps', [('PSS', 'pss'), ('USS', 'uss'), ('SWAP', 'swap')]),
+    ('status', [('THREADS', 'threads'), ('VCTX', 'vctx'), ('NVCTX', 'nvctx')]),
+    ('fd', [('FDS', 'fds')]),
+    ('io', [('RCHAR', 'rchar'), ('WCHAR', 'wchar'), ('READ', 'read_bytes'),
+            ('WRITE', 'write_bytes')]),
+    ('task', [('TASKS', 'tasks'), ('RUNNING', 'running')]),
 ]
 
+def metric_columns(groups):
+    """
+    (column, field) pairs of the given metric groups, in table order.
+    """
+    columns = []
+    for group, group_columns in METRIC_GROUPS:
+        if group in groups:
+            columns.extend(group_columns)
+    return columns
+
 def column_help(keyword_width=10, total_width=70):
     help = []
     for entry in PS_FIELD_HELP:
@@ -117,16 +224,1076 @@ def pretty_timestamp(t=None, style=0):
     else:
         return time.strftime("%Y%m%d%H%M%S", t)
 
-def poll_process(pid=None,
-        command_pattern=None,
+def _monotonic_clock():
+    """
+    Returns a monotonic clock function: time.monotonic where it exists,
+    clock_gettime(CLOCK_MONOTONIC) through ctypes on older Pythons, and
+    time.time as a last resort.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()
+
+class TickScheduler(object):
+    """
+    Drift-free polling schedule. Ticks are kept on a fixed grid of
+    `interval` seconds on the monotonic clock, anchored so that they fall
+    on wall-clock multiples of the interval; the time spent polling does
+    not push later ticks back. When a poll overruns, the ticks it covered
+    are skipped and counted in `missed`.
+    """
+
+    def __init__(self, interval, clock=None):
+        self.interval = float(interval)
+        self.clock = clock or monotonic
+        self.ticks = 0
+        self.missed = 0
+        wall = time.time()
+        delay = self.interval - (wall % self.interval)
+        self.next = self.clock() + delay
+
+    def wait(self):
+        """
+        Sleeps until the next tick and returns how many ticks were missed
+        since the last one.
+        """
+        now = self.clock()
+        if now < self.next:
+            time.sleep(self.next - now)
+            late = 0.0
+        else:
+            late = now - self.next
+        missed = int(late // self.interval)
+        self.missed += missed
+        self.ticks += 1
+        self.next += (missed + 1) * self.interval
+        return missed
+
+def stamp_record(pinfo, poll_time):
+    """
+    Adds the poll timestamp columns to a process record.
+    """
+    pinfo['poll_datetime'] = poll_time.isoformat(' ')
+    pinfo['poll_date'] = poll_time.strftime("%Y-%m-%d")
+    pinfo['poll_time'] = poll_time.strftime("%H:%M:%S")
+    pinfo['poll_time_ms'] = "%s.%03d" % (pinfo['poll_time'], poll_time.microsecond // 1000)
+    pinfo['poll_epoch'] = time.mktime(poll_time.timetuple()) + poll_time.microsecond / 1e6
+
+def format_etime(seconds):
+    """
+    Formats elapsed seconds the way `ps -o etime` does: [[dd-]hh:]mm:ss.
+    """
+    seconds = int(max(seconds, 0))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return "%d-%02d:%02d:%02d" % (days, hours, minutes, seconds)
+    elif hours:
+        return "%02d:%02d:%02d" % (hours, minutes, seconds)
+    else:
+        return "%02d:%02d" % (minutes, seconds)
+
+def _text(data):
+    if str is bytes:
+        return data
+    return data.decode('utf-8', 'replace')
+
+class ProcSampler(object):
+    """
+    Samples processes by reading /proc/<pid>/stat and /proc/<pid>/statm
+    directly instead of forking `ps`. Files stay open between polls (a
+    seek and a read per tick), and command lines are read again only when
+    a process's start time or name changes (PID reuse, or execve), so a
+    sample costs microseconds. Produces the same records as
+    the `ps` path: the PS_FIELDS columns as strings, plus the raw counters
+    they were computed from. `metrics` names the METRIC_GROUPS to read as
+    well; their fields are '-' when a file cannot be read (e.g. another
+    user's process).
+    """
+
+    def __init__(self, proc_root="/proc", metrics=()):
+        self.proc_root = proc_root
+        self.metrics = [group for group, columns in METRIC_GROUPS if group in metrics]
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        self.mem_total_kb = 0
+        for line in open(os.path.join(proc_root, "meminfo")):
+            if line.startswith("MemTotal:"):
+                self.mem_total_kb = int(line.split()[1])
+                break
+        self.boot_time = 0
+        for line in open(os.path.join(proc_root, "stat")):
+            if line.startswith("btime "):
+                self.boot_time = int(line.split()[1])
+                break
+        self.handles = {}
+        self.commands = {}
+        self.matches = {}
+        # /proc/<pid>/task/<tid>/children needs CONFIG_PROC_CHILDREN
+        me = str(os.getpid())
+        self.has_children = os.path.exists(os.path.join(proc_root, me, "task", me, "children"))
+
+    @staticmethod
+    def available(proc_root="/proc"):
+        return os.path.exists(os.path.join(proc_root, "self", "stat"))
+
+    def _open(self, pid):
+        handles = self.handles.get(pid)
+        if handles is None:
+            base = os.path.join(self.proc_root, str(pid))
+            handles = (open(os.path.join(base, "stat"), "rb", 0),
+                       open(os.path.join(base, "statm"), "rb", 0))
+            self.handles[pid] = handles
+        return handles
+
+    def forget(self, pid):
+        handles = self.handles.pop(pid, None)
+        if handles is not None:
+            for handle in handles:
+                handle.close()
+        self.commands.pop(pid, None)
+
+    def close(self):
+        for pid in list(self.handles):
+            self.forget(pid)
+
+    def pids(self):
+        return [int(name) for name in os.listdir(self.proc_root) if name.isdigit()]
+
+    def _children(self, pid):
+        base = os.path.join(self.proc_root, str(pid), "task")
+        children = []
+        try:
+            for tid in os.listdir(base):
+                f = open(os.path.join(base, tid, "children"), "rb")
+                try:
+                    children.extend(int(c) for c in f.read().split())
+                finally:
+                    f.close()
+        except (IOError, OSError):
+            pass
+        return children
+
+    def _ppid(self, pid):
+        try:
+            f = open(os.path.join(self.proc_root, str(pid), "stat"), "rb")
+            try:
+                stat = f.read()
+            finally:
+                f.close()
+            return int(stat[stat.rindex(b")") + 2:].split()[1])
+        except (IOError, OSError, ValueError):
+            return None
+
+    def tree_pids(self, root):
+        """
+        PIDs of the process tree rooted at `root`, root first. Uses the
+        kernel's children lists where available, and otherwise builds a
+        parent map from every process's stat.
+        """
+        tree = [int(root)]
+        if self.has_children:
+            children = self._children
+        else:
+            parents = {}
+            for pid in self.pids():
+                parents.setdefault(self._ppid(pid), []).append(pid)
+            children = lambda pid: parents.get(pid, [])
+        idx = 0
+        while idx < len(tree):
+            tree.extend(children(tree[idx]))
+            idx += 1
+        return tree
+
+    @staticmethod
+    def identity(stat):
+        """
+        (starttime, comm) from the contents of a stat file: a PID whose
+        identity changed is a new process, or one that has exec'd.
+        """
+        close = stat.rindex(b")")
+        return stat[close + 2:].split()[19], stat[stat.index(b"(") + 1:close]
+
+    def command(self, pid, identity=None):
+        """
+        Command line of `pid` as `ps -o command` shows it; kernel threads
+        (empty command line) are shown as [comm]. Cached for as long as
+        the process keeps its identity(), which is read from its stat file
+        unless given.
+        """
+        if identity is None:
+            identity = self.identity(self._read_file(pid, "stat"))
+        cached = self.commands.get(pid)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        base = os.path.join(self.proc_root, str(pid))
+        f = open(os.path.join(base, "cmdline"), "rb")
+        try:
+            args = f.read().rstrip(b"\0").split(b"\0")
+        finally:
+            f.close()
+        command = _text(b" ".join(args))
+        if not command:
+            f = open(os.path.join(base, "comm"), "rb")
+            try:
+                command = "[%s]" % _text(f.read().strip())
+            finally:
+                f.close()
+        self.commands[pid] = (identity, command)
+        return command
+
+    def _read_file(self, pid, name):
+        f = open(os.path.join(self.proc_root, str(pid), name), "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _keyed(self, pid, name):
+        # "Key: value [kB]" lines, as in status, io and smaps_rollup
+        values = {}
+        for line in self._read_file(pid, name).splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                values[_text(fields[0]).rstrip(":")] = fields[1]
+        return values
+
+    def _read_smaps(self, pid):
+        try:
+            values = self._keyed(pid, "smaps_rollup")
+            pss = int(values["Pss"])
+            uss = int(values["Private_Clean"]) + int(values["Private_Dirty"])
+            swap = int(values["Swap"])
+        except (IOError, OSError):
+            # smaps_rollup needs Linux 4.14; sum up the mappings instead
+            pss = uss = swap = 0
+            for line in self._read_file(pid, "smaps").splitlines():
+                if line.startswith(b"Pss:"):
+                    pss += int(line.split()[1])
+                elif line.startswith(b"Private_"):
+                    uss += int(line.split()[1])
+                elif line.startswith(b"Swap:"):
+                    swap += int(line.split()[1])
+        return {'pss': str(pss), 'uss': str(uss), 'swap': str(swap)}
+
+    def _read_status(self, pid):
+        values = self._keyed(pid, "status")
+        return {
+            'threads': _text(values["Threads"]),
+            'vctx': _text(values["voluntary_ctxt_switches"]),
+            'nvctx': _text(values["nonvoluntary_ctxt_switches"]),
+        }
+
+    def _read_fd(self, pid):
+        return {'fds': str(len(os.listdir(os.path.join(self.proc_root, str(pid), "fd"))))}
+
+    def _read_io(self, pid):
+        values = self._keyed(pid, "io")
+        return dict((field, _text(values[field]))
+                for field in ('rchar', 'wchar', 'read_bytes', 'write_bytes'))
+
+    def _read_task(self, pid):
+        base = os.path.join(self.proc_root, str(pid), "task")
+        tasks = running = 0
+        for tid in os.listdir(base):
+            try:
+                f = open(os.path.join(base, tid, "stat"), "rb")
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                continue
+            tasks += 1
+            if stat[stat.rindex(b")") + 2:][:1] == b"R":
+                running += 1
+        return {'tasks': str(tasks), 'running': str(running)}
+
+    def read_threads(self, pid):
+        """
+        Returns (tid, name, cpu ticks, starttime) for each thread of `pid`.
+        """
+        base = os.path.join(self.proc_root, str(pid), "task")
+        threads = []
+        try:
+            tids = os.listdir(base)
+        except (IOError, OSError):
+            return threads
+        for tid in tids:
+            try:
+                f = open(os.path.join(base, tid, "stat"), "rb")
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                continue
+            close = stat.rindex(b")")
+            name = _text(stat[stat.index(b"(") + 1:close])
+            fields = stat[close + 2:].split()
+            threads.append((int(tid), name, int(fields[11]) + int(fields[12]), int(fields[19])))
+        return threads
+
+    def read_metrics(self, pid, pinfo):
+        """
+        Adds the fields of the enabled metric groups to `pinfo`.
+        """
+        for group in self.metrics:
+            try:
+                pinfo.update(getattr(self, "_read_" + group)(pid))
+            except (IOError, OSError, KeyError, ValueError):
+                for column, field in metric_columns([group]):
+                    pinfo[field] = "-"
+
+    def read(self, pid, poll_time=None):
+        """
+        Returns the record for `pid`, or None if it no longer exists.
+        """
+        try:
+            stat_file, statm_file = self._open(pid)
+            stat_file.seek(0)
+            stat = stat_file.read()
+            statm_file.seek(0)
+            statm = statm_file.read().split()
+            if stat:
+                command = self.command(pid, self.identity(stat))
+        except (IOError, OSError, ValueError):
+            self.forget(pid)
+            return None
+        if not stat:
+            self.forget(pid)
+            return None
+        # the command name in parentheses may itself contain spaces
+        fields = stat[stat.rindex(b")") + 2:].split()
+        if poll_time is None:
+            poll_time = datetime.datetime.now()
+        now = time.time()
+        utime, stime, cutime, cstime = [int(f) for f in fields[11:15]]
+        starttime = int(fields[19])
+        elapsed = now - (self.boot_time + starttime / self.clock_ticks)
+        cpu_seconds = (utime + stime) / self.clock_ticks
+        rss_kb = int(statm[1]) * self.page_kb
+        vsz_kb = int(statm[0]) * self.page_kb
+        pinfo = {
+            'pid': str(pid),
+            'ppid': _text(fields[1]),
+            'etime': format_etime(elapsed),
+            '%cpu': "%.1f" % (elapsed > 0 and cpu_seconds * 100.0 / elapsed or 0.0),
+            '%mem': "%.1f" % (self.mem_total_kb and rss_kb * 100.0 / self.mem_total_kb or 0.0),
+            'rss': str(rss_kb),
+            'vsz': str(vsz_kb),
+            'command': command,
+            'state': _text(fields[0]),
+            'utime': utime,
+            'stime': stime,
+            'cutime': cutime,
+            'cstime': cstime,
+            'num_threads': int(fields[17]),
+            'starttime': starttime,
+            'raw_stat': _text(stat.strip()),
+        }
+        stamp_record(pinfo, poll_time)
+        if self.metrics:
+            self.read_metrics(pid, pinfo)
+        return pinfo
+
+    def poll_targets(self, targets,
+            ignore_self=True,
+            raw_ps_log=None,
+            debug_level=0,
+            tree=False):
+        """
+        Samples every Target in one pass and returns a list of record lists,
+        one per target. /proc is listed at most once per call, each pattern
+        is matched once per process (the result is cached for as long as
+        the process keeps its identity(), so a child forked from a
+        matching process is matched again once it execs), and a process
+        wanted by several targets is read once.
+        """
+        poll_time = datetime.datetime.now()
+        self_pid = os.getpid()
+        matched = [[] for target in targets]
+        if [t for t in targets if t.pid is None]:
+            alive = self.pids()
+            alive_set = set(alive)
+            for stale in [p for p in self.matches if p not in alive_set]:
+                del self.matches[stale]
+                self.forget(stale)
+            for pid in alive:
+                try:
+                    identity = self.identity(self._read_file(pid, "stat"))
+                except (IOError, OSError, ValueError):
+                    continue
+                cached = self.matches.get(pid)
+                if cached is not None and cached[0] == identity:
+                    matches = cached[1]
+                else:
+                    try:
+                        command = self.command(pid, identity)
+                    except (IOError, OSError):
+                        continue
+                    matches = tuple(idx for idx, t in enumerate(targets)
+                            if t.pid is None and t.matches(command))
+                    self.matches[pid] = (identity, matches)
+                for idx in matches:
+                    matched[idx].append(pid)
+        reads = {}
+        results = []
+        for idx, target in enumerate(targets):
+            if target.pid is None:
+                candidates = matched[idx]
+            elif tree:
+                candidates = self.tree_pids(target.pid)
+            else:
+                candidates = [int(target.pid)]
+                if target.pattern is not None:
+                    try:
+                        if not target.matches(self.command(candidates[0])):
+                            candidates = []
+                    except (IOError, OSError):
+                        candidates = []
+            records = []
+            for candidate in candidates:
+                if ignore_self and candidate == self_pid:
+                    continue
+                if candidate not in reads:
+                    pinfo = self.read(candidate, poll_time)
+                    reads[candidate] = pinfo
+                    if pinfo is not None:
+                        if raw_ps_log is not None:
+                            raw_ps_log.write(pinfo['raw_stat'] + "\n")
+                        if debug_level >= 4:
+                            sys.stderr.write(str(pinfo) + "\n")
+                if reads[candidate] is not None:
+                    records.append(reads[candidate])
+            results.append(records)
+        # keep files open only for processes that are still being sampled
+        for stale in [p for p in self.handles if p not in reads]:
+            self.forget(stale)
+        return results
+
+def select_tree(records, root):
+    """
+    Returns the records of the process tree rooted at PID `root`,
+    following ppid links; the root comes first.
+    """
+    by_pid = {}
+    children = {}
+    for pinfo in records:
+        by_pid[pinfo['pid']] = pinfo
+        children.setdefault(pinfo['ppid'], []).append(pinfo['pid'])
+    root = str(root)
+    if root not in by_pid:
+        return []
+    tree = [root]
+    idx = 0
+    while idx < len(tree):
+        tree.extend(children.get(tree[idx], []))
+        idx += 1
+    return [by_pid[p] for p in tree]
+
+class TreeRollup(object):
+    """
+    Per-poll totals for a process tree: process count, processes spawned
+    and exited since the previous poll, RSS, VSIZE and CPU. CPU comes from
+    the change in the tree's cumulative CPU ticks -- utime+stime of the
+    live members plus the cutime+cstime they have collected from reaped
+    children -- so plugins that start and exit between two polls are still
+    charged to the tree once their parent reaps them. Records without raw
+    counters (the ps backend) fall back to summing %cpu.
+    """
+
+    def __init__(self, root, clock_ticks=None):
+        self.root = root
+        self.clock_ticks = clock_ticks or float(os.sysconf('SC_CLK_TCK'))
+        self.members = None
+        self.cpu_ticks = None
+        self.epoch = None
+        self.spawned = 0
+        self.exited = 0
+
+    def update(self, records):
+        """
+        Returns the rollup record for one poll of the tree, or None if the
+        tree is gone.
+        """
+        if not records:
+            return None
+        # (pid, starttime) so that a recycled PID counts as a new process
+        members = set((p['pid'], p.get('starttime')) for p in records)
+        if self.members is None:
+            spawned = exited = 0
+        else:
+            spawned = len(members - self.members)
+            exited = len(self.members - members)
+        self.spawned += spawned
+        self.exited += exited
+        epoch = records[0]['poll_epoch']
+        if 'utime' in records[0]:
+            cpu_ticks = sum(p['utime'] + p['stime'] + p['cutime'] + p['cstime'] for p in records)
+        else:
+            cpu_ticks = None
+        if cpu_ticks is not None and self.cpu_ticks is not None and epoch > self.epoch:
+            # members re-parented outside the tree take their ticks along
+            used = max(cpu_ticks - self.cpu_ticks, 0) / self.clock_ticks
+            cpu = used * 100.0 / (epoch - self.epoch)
+        else:
+            cpu = sum(float(p['%cpu']) for p in records)
+        self.members = members
+        self.cpu_ticks = cpu_ticks
+        self.epoch = epoch
+        rollup = {
+            'root': str(self.root),
+            'procs': str(len(records)),
+            'spawned': str(spawned),
+            'exited': str(exited),
+            '%cpu': "%.1f" % cpu,
+            'rss': str(sum(int(p['rss']) for p in records)),
+            'vsz': str(sum(int(p['vsz']) for p in records)),
+        }
+        for key in ('poll_datetime', 'poll_date', 'poll_time', 'poll_time_ms', 'poll_epoch'):
+            rollup[key] = records[0][key]
+        return rollup
+
+class RunningStats(object):
+    """
+    Count, min, max, mean and standard deviation of a stream of values in
+    constant memory (Welford's method).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+class P2Quantile(object):
+    """
+    Streaming estimate of the `p` quantile in constant memory, using the
+    P-square algorithm (Jain and Chlamtac, 1985): five markers whose
+    heights are adjusted by piecewise-parabolic interpolation as values
+    arrive. Exact until five values have been seen.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+    def add(self, x):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = d > 0 and 1 or -1
+                h = self._parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+    def value(self):
+        q = self.heights
+        if not q:
+            return None
+        if len(q) < 5 or self.positions[4] == 5:
+            return q[int(round(self.p * (len(q) - 1)))]
+        return q[2]
+
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+
+SUMMARY_METRICS = [('cpu', '%cpu'), ('mem', '%mem'), ('rss', 'rss'), ('vsz', 'vsz')]
+
+class SampleSummary(object):
+    """
+    Online statistics -- min, max, mean, stddev and the SUMMARY_QUANTILES
+    -- for each metric of the records added, where `metrics` maps a
+    summary name to a record field.
+    """
+
+    def __init__(self, metrics=SUMMARY_METRICS):
+        self.metrics = list(metrics)
+        self.count = 0
+        self.stats = {}
+        self.quantiles = {}
+        for name, field in self.metrics:
+            self.stats[name] = RunningStats()
+            self.quantiles[name] = [P2Quantile(p) for p in SUMMARY_QUANTILES]
+
+    def add_record(self, pinfo):
+        self.count += 1
+        for name, field in self.metrics:
+            if pinfo[field] == "-":
+                continue
+            value = float(pinfo[field])
+            self.stats[name].add(value)
+            for quantile in self.quantiles[name]:
+                quantile.add(value)
+
+    def as_dict(self):
+        metrics = {}
+        for name, field in self.metrics:
+            stats = self.stats[name]
+            entry = {
+                'min': stats.min,
+                'max': stats.max,
+                'mean': stats.mean,
+                'stddev': stats.stddev(),
+            }
+            for quantile in self.quantiles[name]:
+                entry['p%d' % round(quantile.p * 100)] = quantile.value()
+            metrics[name] = entry
+        return {'samples': self.count, 'metrics': metrics}
+
+def _betacf(a, b, x):
+    # continued fraction for the incomplete beta function (Numerical Recipes)
+    tiny = 1e-30
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-12:
+            break
+    return h
+
+def betainc(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b).
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+            + a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+def student_t_sf(t, dof):
+    """
+    P(T > t) for Student's t distribution with `dof` degrees of freedom.
+    """
+    tail = 0.5 * betainc(dof / 2.0, 0.5, dof / (dof + t * t))
+    if t > 0:
+        return tail
+    return 1.0 - tail
+
+def student_t_ppf(p, dof):
+    """
+    The t such that P(T <= t) = `p`, by bisection on student_t_sf().
+    """
+    if p == 0.5:
+        return 0.0
+    if p < 0.5:
+        return -student_t_ppf(1.0 - p, dof)
+    lo, hi = 0.0, 1.0
+    while student_t_sf(hi, dof) > 1.0 - p:
+        hi *= 2.0
+    for i in range(100):
+        mid = (lo + hi) / 2.0
+        if student_t_sf(mid, dof) > 1.0 - p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2.0
+
+class LeakDetector(object):
+    """
+    Online least-squares trend of RSS over a sliding window of `window`
+    seconds, ignoring the first `warmup` seconds. Growth counts as a leak
+    when the fitted slope exceeds `threshold` bytes per hour with at least
+    `confidence` (one-sided t-test on the slope) over a full window; once
+    any window has been flagged, the run counts as leaking. The
+    regression sums are updated as samples enter and leave the window, so
+    each sample costs O(1).
+    """
+
+    def __init__(self, threshold, window=3600.0, warmup=300.0, confidence=0.95):
+        self.threshold = float(threshold)
+        self.window = float(window)
+        self.warmup = float(warmup)
+        self.confidence = confidence
+        self.start = None
+        self.points = []
+        self.head = 0
+        self.n = 0
+        self.st = self.sy = self.stt = self.sty = self.syy = 0.0
+        self.first_flagged = None
+        self.flagged_slope = None
+        self.flagged_confidence = None
+
+    def _update(self, t, y, sign):
+        self.n += sign
+        self.st += sign * t
+        self.sy += sign * y
+        self.stt += sign * t * t
+        self.sty += sign * t * y
+        self.syy += sign * y * y
+
+    def add(self, epoch, rss_kb):
+        if self.start is None:
+            self.start = epoch
+        t = epoch - self.start
+        if t < self.warmup:
+            return
+        y = float(rss_kb)
+        self.points.append((t, y))
+        self._update(t, y, 1)
+        # keep one point at or before the start of the window, so that a
+        # full window spans `window` whatever the poll interval
+        while self.head + 1 < len(self.points) and \
+                t - self.points[self.head + 1][0] >= self.window:
+            old_t, old_y = self.points[self.head]
+            self._update(old_t, old_y, -1)
+            self.head += 1
+        if self.head > 1024 and self.head * 2 > len(self.points):
+            del self.points[:self.head]
+            self.head = 0
+        if self.first_flagged is None and self.leaking():
+            self.first_flagged = epoch
+            self.flagged_slope = self.fit()[0] * 1024 * 3600
+            self.flagged_confidence = self.slope_confidence()
+
+    def span(self):
+        if self.n < 2:
+            return 0.0
+        return self.points[-1][0] - self.points[self.head][0]
+
+    def fit(self):
+        """
+        Returns (slope in kB/s, intercept, r squared, standard error of the
+        slope) for the current window, or None if it cannot be fitted.
+        """
+        n = self.n
+        if n < 3:
+            return None
+        sxx = self.stt - self.st * self.st / n
+        sxy = self.sty - self.st * self.sy / n
+        syy = self.syy - self.sy * self.sy / n
+        if sxx <= 0:
+            return None
+        slope = sxy / sxx
+        intercept = (self.sy - slope * self.st) / n
+        sse = max(syy - slope * sxy, 0.0)
+        r2 = syy > 0 and 1.0 - sse / syy or 0.0
+        se = math.sqrt(sse / (n - 2) / sxx)
+        return slope, intercept, r2, se
+
+    def slope_confidence(self, fitted=None):
+        """
+        Confidence that the true slope is above the threshold.
+        """
+        fitted = fitted or self.fit()
+        if fitted is None:
+            return 0.0
+        slope, intercept, r2, se = fitted
+        threshold = self.threshold / 1024.0 / 3600.0
+        if se == 0:
+            return slope > threshold and 1.0 or 0.0
+        return 1.0 - student_t_sf((slope - threshold) / se, self.n - 2)
+
+    def leaking(self):
+        if self.span() < self.window * 0.999:
+            return False
+        return self.slope_confidence() >= self.confidence
+
+    def verdict(self):
+        """
+        Structured verdict: 'status' is 'leak' if any full window so far
+        was flagged (see 'first_flagged'), else 'ok', or 'insufficient'
+        if no window has been filled yet. 'window_status' is the same
+        judgement for the current window alone.
+        """
+        fitted = self.fit()
+        verdict = {
+            'threshold_bytes_per_hour': self.threshold,
+            'window_seconds': self.window,
+            'warmup_seconds': self.warmup,
+            'required_confidence': self.confidence,
+            'span_seconds': self.span(),
+            'samples': self.n,
+            'slope_bytes_per_hour': None,
+            'confidence': None,
+            'r_squared': None,
+            'first_flagged': self.first_flagged,
+            'flagged_slope_bytes_per_hour': self.flagged_slope,
+            'flagged_confidence': self.flagged_confidence,
+        }
+        if fitted is None or self.span() < self.window * 0.999:
+            verdict['window_status'] = 'insufficient'
+        else:
+            verdict['window_status'] = self.leaking() and 'leak' or 'ok'
+        if self.first_flagged is not None:
+            verdict['status'] = 'leak'
+        else:
+            verdict['status'] = verdict['window_status']
+        if fitted is not None:
+            slope, intercept, r2, se = fitted
+            verdict['slope_bytes_per_hour'] = slope * 1024 * 3600
+            verdict['confidence'] = self.slope_confidence(fitted)
+            verdict['r_squared'] = r2
+        return verdict
+
+class ThreadTracker(object):
+    """
+    Per-thread CPU of a target, from the change in each thread's
+    utime+stime between polls -- the share of the last interval rather
+    than the lifetime ratio `ps` gives. A thread seen for the first time
+    is charged for its whole life so far, which falls inside the interval
+    unless this is the first poll. Also totals each thread's CPU time over
+    the run for the hot-thread summary.
+    """
+
+    def __init__(self, clock_ticks, boot_time):
+        self.clock_ticks = clock_ticks
+        self.boot_time = boot_time
+        self.last = {}
+        self.totals = {}
+        self.polls = 0
+
+    def update(self, samples, poll_record):
+        """
+        `samples` holds (pid, ProcSampler.read_threads(pid)) pairs for one
+        poll; `poll_record` supplies the poll timestamp fields. Returns a
+        record per thread.
+        """
+        epoch = poll_record['poll_epoch']
+        seen = {}
+        rows = []
+        for pid, threads in samples:
+            for tid, name, ticks, starttime in threads:
+                key = (pid, tid, starttime)
+                last = self.last.get(key)
+                if last is not None and epoch > last[1]:
+                    used = ticks - last[0]
+                    cpu = used / self.clock_ticks * 100.0 / (epoch - last[1])
+                else:
+                    used = self.polls and ticks or 0
+                    age = epoch - (self.boot_time + starttime / self.clock_ticks)
+                    cpu = age > 0 and ticks / self.clock_ticks * 100.0 / age or 0.0
+                seen[key] = (ticks, epoch)
+                total = self.totals.get(key)
+                if total is None:
+                    total = self.totals[key] = {'pid': pid, 'tid': tid, 'cpu_seconds': 0.0,
+                            'max_cpu': 0.0, 'cpu_sum': 0.0, 'samples': 0}
+                total['name'] = name
+                total['cpu_seconds'] += used / self.clock_ticks
+                total['max_cpu'] = max(total['max_cpu'], cpu)
+                total['cpu_sum'] += cpu
+                total['samples'] += 1
+                row = {'pid': str(pid), 'tid': str(tid), 'name': name, '%cpu': "%.1f" % cpu}
+                for field in ('poll_datetime', 'poll_date', 'poll_time', 'poll_time_ms', 'poll_epoch'):
+                    row[field] = poll_record[field]
+                rows.append(row)
+        self.last = seen
+        self.polls += 1
+        return rows
+
+    def hot_threads(self, limit=10):
+        """
+        Summary of the threads that used the most CPU time, and of CPU time
+        by thread name (e.g. all the threads of a pool).
+        """
+        threads = sorted(self.totals.values(), key=lambda t: (-t['cpu_seconds'], t['tid']))
+        hot = []
+        for t in threads[:limit]:
+            hot.append({
+                'pid': t['pid'],
+                'tid': t['tid'],
+                'name': t['name'],
+                'cpu_seconds': t['cpu_seconds'],
+                'mean_cpu': t['cpu_sum'] / t['samples'],
+                'max_cpu': t['max_cpu'],
+            })
+        by_name = {}
+        for t in threads:
+            entry = by_name.setdefault(t['name'], {'threads': 0, 'cpu_seconds': 0.0})
+            entry['threads'] += 1
+            entry['cpu_seconds'] += t['cpu_seconds']
+        return {'hot': hot, 'by_name': by_name}
+
+def make_sampler(backend="auto", metrics=()):
+    """
+    Returns a ProcSampler for the 'proc' backend (or for 'auto' when /proc
+    is available), or None to sample through `ps`. Metric groups can only
+    be read from /proc.
+    """
+    if backend == "ps":
+        if metrics:
+            raise Exception("Metric groups need the /proc backend")
+        return None
+    if backend == "proc" or ProcSampler.available():
+        return ProcSampler(metrics=metrics)
+    if metrics:
+        raise Exception("Metric groups need the /proc backend")
+    return None
+
+class Target(object):
+    """
+    Something to profile: the process with PID `pid`, or every process
+    whose command matches the regular expression `command_pattern`, or
+    (with neither) every process. Each target has its own `label` and
+    output streams (and optionally a sample_store.ColumnWriter).
+    """
+
+    def __init__(self, label=None, pid=None, command_pattern=None,
+            output=None, tree_output=None, store=None):
+        self.label = label
+        self.pid = pid
+        self.command_pattern = command_pattern
+        if command_pattern is not None:
+            self.pattern = re.compile(command_pattern)
+        else:
+            self.pattern = None
+        self.output = output
+        self.tree_output = tree_output
+        self.store = store
+        self.summary = SampleSummary()
+        self.tree_summary = None
+        self.leak_detector = None
+        self.thread_output = None
+        self.thread_tracker = None
+
+    def matches(self, command):
+        return self.pattern is None or self.pattern.search(command) is not None
+
+def target_label(pid=None, command_pattern=None):
+    """
+    Default label for a target, usable in file names.
+    """
+    if pid is not None:
+        return "pid%d" % int(pid)
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", command_pattern).strip("_.")[:40] or "command"
+
+def unique_labels(targets):
+    """
+    Renames targets whose label is already taken to `label_2`,
+    `label_3`, ..., so that labels (and so file names) are unique.
+    """
+    taken = set(target.label for target in targets)
+    seen = set()
+    for target in targets:
+        if target.label in seen:
+            count = 2
+            while "%s_%d" % (target.label, count) in taken:
+                count += 1
+            target.label = "%s_%d" % (target.label, count)
+            taken.add(target.label)
+        seen.add(target.label)
+    return targets
+
+def poll_targets(targets,
         ignore_self=True,
         raw_ps_log=None,
-        debug_level=0):
+        debug_level=0,
+        sampler=None,
+        tree=False):
     """
-    Calls ps, and extracts rows where command matches given command
-    filter. If no filter is given, all rows are extracted.
+    Samples all `targets` (Target instances) from a single process
+    listing, and returns a list of record lists, one per target. With
+    `sampler` the listing comes from /proc (see ProcSampler.poll_targets),
+    otherwise from one ps call. If `tree` is True, the targets given by
+    PID also get all of their descendants.
     """
 
+    if sampler is not None:
+        return sampler.poll_targets(targets,
+                ignore_self=ignore_self,
+                raw_ps_log=raw_ps_log,
+                debug_level=debug_level,
+                tree=tree)
+
     # count up all the fields so far
     # we are relying on all these fields NOT to contain
     # any space; we'll use this fact to parse out columns
@@ -147,7 +1314,7 @@ def poll_process(pid=None,
         shell=True,
         stdout=subprocess.PIPE)
     poll_time = datetime.datetime.now()
-    stdout = ps.communicate()[0]
+    stdout = _text(ps.communicate()[0])
 
     if debug_level >= 9:
         sys.stderr.write(stdout + "\n")
@@ -156,6 +1323,7 @@ def poll_process(pid=None,
         raw_ps_log.write(stdout + "\n")
 
     records = []
+    by_pid = {}
     for row in stdout.split("\n"):
         if not row:
             continue
@@ -166,19 +1334,52 @@ def poll_process(pid=None,
             #raise ValueError("Expecting 8 columns in output, but found %d: %s" % (len(fields), fields))
             sys.stderr.write("SYRUPY: Skipping sample: found only %d columns: %s" % (len(fields), fields))
             continue
-        if (not ignore_self or int(fields[0]) != os.getpid())  \
-                and (pid is None or int(fields[0]) == int(pid)) \
-                and (command_pattern is None or re.search(command_pattern, fields[-1])):
-            pinfo = {}
-            for idx, field in enumerate(fields):
-                pinfo[ps_fields[idx]] = field
-            pinfo['poll_datetime'] = poll_time.isoformat(' ')
-            pinfo['poll_date'] = poll_time.strftime("%Y-%m-%d")
-            pinfo['poll_time'] = poll_time.strftime("%H:%M:%S")
-            records.append(pinfo)
-            if debug_level >= 4:
+        if ignore_self and int(fields[0]) == os.getpid():
+            continue
+        pinfo = {}
+        for idx, field in enumerate(fields):
+            pinfo[ps_fields[idx]] = field
+        stamp_record(pinfo, poll_time)
+        records.append(pinfo)
+        by_pid[int(fields[0])] = pinfo
+
+    results = []
+    for target in targets:
+        if target.pid is None:
+            selected = [pinfo for pinfo in records if target.matches(pinfo['command'])]
+        elif tree:
+            selected = select_tree(records, target.pid)
+        elif int(target.pid) in by_pid and target.matches(by_pid[int(target.pid)]['command']):
+            selected = [by_pid[int(target.pid)]]
+        else:
+            selected = []
+        if debug_level >= 4:
+            for pinfo in selected:
                 sys.stderr.write(str(pinfo) + "\n")
-    return records
+        results.append(selected)
+    return results
+
+def poll_process(pid=None,
+        command_pattern=None,
+        ignore_self=True,
+        raw_ps_log=None,
+        debug_level=0,
+        sampler=None,
+        tree=False):
+    """
+    Calls ps, and extracts rows where command matches given command
+    filter. If no filter is given, all rows are extracted. If `sampler`
+    is given, it is used to read the same information from /proc instead.
+    If `tree` is True, the process with PID `pid` and all of its
+    descendants are extracted.
+    """
+    target = Target(pid=pid, command_pattern=command_pattern)
+    return poll_targets([target],
+            ignore_self=ignore_self,
+            raw_ps_log=raw_ps_log,
+            debug_level=debug_level,
+            sampler=sampler,
+            tree=tree)[0]
 
 def profile_process(pid=None,
         command_pattern=None,
@@ -193,7 +1394,18 @@ def profile_process(pid=None,
         align=False,
         headers=True,
         flush_output=False,
-        debug_level=0):
+        debug_level=0,
+        backend="auto",
+        tree=False,
+        tree_output=None,
+        targets=None,
+        show_label=False,
+        store=None,
+        summary_output=None,
+        metrics=(),
+        leak_detection=None,
+        threads=False,
+        thread_output=None):
     """
     Will poll process with PID `pid` or with COMMAND matching
     `command_pattern` every `poll_interval` seconds, writing system
@@ -203,11 +1415,59 @@ def profile_process(pid=None,
     True, otherwise will continue until time given by `quit_at_time` if
     `quit_at_time` is not None. If `quit_at_time` is None and the PID
     does not exist and if `quit_if_none` is False, then will poll
-    continuously until interupted by user.
+    continuously until interupted by user. `backend` selects how samples
+    are taken: 'proc', 'ps', or 'auto' (/proc when available). Polls
+    follow a TickScheduler, so they stay on the interval grid however long
+    each poll takes; sub-second intervals also get millisecond timestamps.
+    If `tree` is True, every process descended from `pid` is reported as
+    well, and a TreeRollup row per poll is written to `tree_output`.
+    Several processes can be profiled at once by passing a list of Target
+    instances as `targets` instead of `pid` and `command_pattern`: all are
+    sampled from the same process listing on each poll, and each target's
+    rows go to its own `output` and `tree_output`. `quit_if_none` then
+    quits once none of the targets has any process left. If `show_label`
+    is True, rows start with the target label. Samples are also appended
+    to `store` (or each target's `store`), a sample_store.ColumnWriter,
+    if given. Each target keeps a SampleSummary of its samples (and of its
+    tree totals); when polling ends they are returned as a dictionary,
+    which is also written to `summary_output` as JSON if given. `metrics`
+    names extra METRIC_GROUPS to sample (with the /proc backend); they get
+    their own columns and summaries. Interrupting the run (Ctrl-C, or
+    SIGTERM as main() sets it up) ends polling as if the processes had
+    gone, so the summary is still written; it is then marked
+    'interrupted'. If `leak_detection` is a dictionary
+    of LeakDetector arguments, each target's total RSS per poll is fed to
+    its own detector, whose verdict is added to the summary as 'leak'.
+    If `threads` is True (/proc backend only), every thread of the sampled
+    processes gets a row per poll in `thread_output` (or the target's
+    `thread_output`), with CPU over the last interval from a
+    ThreadTracker, and the hottest threads are added to the summary.
     """
 
-    if pid is None and command_pattern is None:
-        raise Exception("Must provide either PID or command pattern")
+    if targets is None:
+        if pid is None and command_pattern is None:
+            raise Exception("Must provide either PID or command pattern")
+        targets = [Target(pid=pid,
+                command_pattern=command_pattern,
+                output=syrupy_output,
+                tree_output=tree_output,
+                store=store)]
+        targets[0].thread_output = thread_output
+    if tree and [t for t in targets if t.pid is None]:
+        raise Exception("Tree mode needs a PID to use as the root")
+    extra_columns = metric_columns(metrics)
+    for target in targets:
+        if target.label is None:
+            target.label = target_label(target.pid, target.command_pattern)
+        if extra_columns:
+            target.summary = SampleSummary(SUMMARY_METRICS
+                    + [(field, field) for column, field in extra_columns])
+        if tree:
+            target.tree_summary = SampleSummary((('cpu', '%cpu'), ('rss', 'rss'),
+                    ('vsz', 'vsz'), ('procs', 'procs')))
+        if leak_detection is not None:
+            target.leak_detector = LeakDetector(**leak_detection)
+    start_time = datetime.datetime.now()
 
     if align:
         ncolw = 5
@@ -230,10 +1490,19 @@ def profile_process(pid=None,
         left_align = ""
         left_align_wide = ""
 
+    # sub-second polling needs sub-second timestamps to be correlated
+    if poll_interval < 1:
+        time_field = "poll_time_ms"
+        tcolw = mcolw and mcolw + 4
+    else:
+        time_field = "poll_time"
+        tcolw = mcolw
+    time_align = tcolw and "%d" % tcolw or ""
+
     result_fields = [
         "%%(pid)%ss" % right_align,
         "%%(poll_date)%ss" % right_align_wide,
-        "%%(poll_time)%ss" % right_align,
+        "%%(%s)%ss" % (time_field, time_align),
         "%%(etime)%ss" % right_align_wide,
         "%%(%%cpu)%ss" % right_align_narrow,
         "%%(%%mem)%ss" % right_align_narrow,
@@ -241,6 +1510,9 @@ def profile_process(pid=None,
         "%%(vsz)%ss" % right_align,
     ]
 
+    for column, field in extra_columns:
+        result_fields.append("%%(%s)%ss" % (field, right_align))
+
     if debug_level >= 1:
         result_fields.insert(0, "%%(ppid)%ss" % right_align)
 
@@ -250,7 +1522,7 @@ def profile_process(pid=None,
     col_headers = [
         "PID".rjust(mcolw),
         "DATE".rjust(wcolw),
-        "TIME".rjust(mcolw),
+        "TIME".rjust(tcolw),
         "ELAPSED".rjust(wcolw),
         "CPU".rjust(ncolw),
         "MEM".rjust(ncolw),
@@ -258,40 +1530,215 @@ def profile_process(pid=None,
         "VSIZE".rjust(mcolw)
     ]
 
+    for column, field in extra_columns:
+        col_headers.append(column.rjust(mcolw))
+
     if debug_level >=1:
         col_headers.insert(0, "PPID".rjust(mcolw))
 
     if show_command:
         col_headers.append("COMMAND")
 
+    if show_label:
+        lcolw = align and max([len(str(t.label)) for t in targets] + [6]) or 0
+        label_field = lcolw and "%%(label)-%ds" % lcolw or "%(label)s"
+        result_fields.insert(0, label_field)
+        col_headers.insert(0, "TARGET".ljust(lcolw))
+
+    tree_fields = [
+        "%%(root)%ss" % right_align,
+        "%%(poll_date)%ss" % right_align_wide,
+        "%%(%s)%ss" % (time_field, time_align),
+        "%%(procs)%ss" % right_align_narrow,
+        "%%(spawned)%ss" % right_align_narrow,
+        "%%(exited)%ss" % right_align_narrow,
+        "%%(%%cpu)%ss" % right_align_narrow,
+        "%%(rss)%ss" % right_align,
+        "%%(vsz)%ss" % right_align,
+    ]
+
+    tree_headers = [
+        "ROOT".rjust(mcolw),
+        "DATE".rjust(wcolw),
+        "TIME".rjust(tcolw),
+        "PROCS".rjust(ncolw),
+        "SPAWNED".rjust(ncolw),
+        "EXITED".rjust(ncolw),
+        "CPU".rjust(ncolw),
+        "RSS".rjust(mcolw),
+        "VSIZE".rjust(mcolw)
+    ]
+
+    if show_label:
+        tree_fields.insert(0, label_field)
+        tree_headers.insert(0, "TARGET".ljust(lcolw))
+
+    thread_fields = [
+        "%%(pid)%ss" % right_align,
+        "%%(tid)%ss" % right_align,
+        "%%(poll_date)%ss" % right_align_wide,
+        "%%(%s)%ss" % (time_field, time_align),
+        "%%(%%cpu)%ss" % right_align_narrow,
+        "%(name)s",
+    ]
+
+    thread_headers = [
+        "PID".rjust(mcolw),
+        "TID".rjust(mcolw),
+        "DATE".rjust(wcolw),
+        "TIME".rjust(tcolw),
+        "CPU".rjust(ncolw),
+        "THREAD",
+    ]
+
+    if show_label:
+        thread_fields.insert(0, label_field)
+        thread_headers.insert(0, "TARGET".ljust(lcolw))
+
     if headers:
-        if syrupy_output is not None:
-            syrupy_output.write(output_separator.join(col_headers) + "\n")
-            if flush_output:
-                syrupy_output.flush()
+        # targets may share an output stream; give it one header
+        seen = set()
+        for target in targets:
+            streams = [(target.output, col_headers)]
+            if tree:
+                streams.append((target.tree_output, tree_headers))
+            if threads:
+                streams.append((target.thread_output, thread_headers))
+            for stream, stream_headers in streams:
+                if stream is None or id(stream) in seen:
+                    continue
+                seen.add(id(stream))
+                stream.write(output_separator.join(stream_headers) + "\n")
+                if flush_output:
+                    stream.flush()
+
+    sampler = make_sampler(backend, metrics)
+    if threads and sampler is None:
+        raise Exception("Per-thread sampling needs the /proc backend")
+    scheduler = TickScheduler(poll_interval)
+    if tree:
+        clock_ticks = sampler is not None and sampler.clock_ticks or None
+        rollups = [TreeRollup(t.pid, clock_ticks) for t in targets]
+    if threads:
+        for target in targets:
+            target.thread_tracker = ThreadTracker(sampler.clock_ticks, sampler.boot_time)
 
     quit = False
-    while not quit:
-        pinfoset = poll_process(pid=pid,
-                                command_pattern=command_pattern,
-                                raw_ps_log=raw_ps_log,
-                                debug_level=debug_level)
-        if debug_level > 4:
-            sys.stderr.write(str(pinfoset) + "\n")
-        if raw_ps_log is not None and flush_output:
-            raw_ps_log.flush()
-        for pinfo in pinfoset:
-            result = output_separator.join(result_fields) % pinfo
-            if syrupy_output is not None:
-                syrupy_output.write(result + "\n")
-                if flush_output:
-                    syrupy_output.flush()
-        if quit_poll_func is not None and quit_poll_func():
-            quit = True
-        elif len(pinfoset) == 0 and quit_if_none:
-            quit = True
-        else:
-            time.sleep(poll_interval)
+    interrupted = False
+    polls = 0
+    try:
+        while not quit:
+            results = poll_targets(targets,
+                                   raw_ps_log=raw_ps_log,
+                                   debug_level=debug_level,
+                                   sampler=sampler,
+                                   tree=tree)
+            polls += 1
+            if debug_level > 4:
+                sys.stderr.write(str(results) + "\n")
+            if raw_ps_log is not None and flush_output:
+                raw_ps_log.flush()
+            for idx, target in enumerate(targets):
+                pinfoset = results[idx]
+                output = target.output
+                for pinfo in pinfoset:
+                    if show_label:
+                        pinfo = dict(pinfo, label=target.label)
+                    result = output_separator.join(result_fields) % pinfo
+                    if output is not None:
+                        output.write(result + "\n")
+                    if target.store is not None:
+                        target.store.append_record(pinfo)
+                    target.summary.add_record(pinfo)
+                if output is not None and flush_output:
+                    output.flush()
+                if target.store is not None and flush_output:
+                    target.store.flush()
+                if threads and pinfoset:
+                    rows = target.thread_tracker.update(
+                            [(int(pinfo['pid']), sampler.read_threads(pinfo['pid'])) for pinfo in pinfoset],
+                            pinfoset[0])
+                    if target.thread_output is not None:
+                        for row in rows:
+                            row['label'] = target.label
+                            target.thread_output.write(output_separator.join(thread_fields) % row + "\n")
+                        if flush_output:
+                            target.thread_output.flush()
+                rss = sum(int(pinfo['rss']) for pinfo in pinfoset)
+                # no resident memory at all: the process is exiting (a zombie)
+                if target.leak_detector is not None and rss > 0:
+                    detector = target.leak_detector
+                    flagged = detector.first_flagged
+                    detector.add(pinfoset[0]['poll_epoch'], rss)
+                    if flagged is None and detector.first_flagged is not None:
+                        sys.stderr.write("SYRUPY: %s: RSS growing faster than %d bytes/hour\n" \
+                            % (target.label, detector.threshold))
+                if tree:
+                    totals = rollups[idx].update(pinfoset)
+                    if totals is not None:
+                        target.tree_summary.add_record(totals)
+                    if totals is not None and target.tree_output is not None:
+                        totals['label'] = target.label
+                        target.tree_output.write(output_separator.join(tree_fields) % totals + "\n")
+                        if flush_output:
+                            target.tree_output.flush()
+            if quit_poll_func is not None and quit_poll_func():
+                quit = True
+            elif quit_if_none and not [r for r in results if r]:
+                quit = True
+            else:
+                scheduler.wait()
+    except KeyboardInterrupt:
+        interrupted = True
+        sys.stderr.write("SYRUPY: Interrupted\n")
+    finally:
+        # stores buffer up to a block of samples; never leave them unwritten
+        if sampler is not None:
+            sampler.close()
+        for target in targets:
+            if target.store is not None:
+                target.store.close()
+    for target in targets:
+        if threads and target.thread_tracker.totals:
+            hot = target.thread_tracker.hot_threads(5)['hot']
+            sys.stderr.write("SYRUPY: %s: hottest threads: %s\n" % (target.label,
+                ", ".join("%s[%d] %.2fs" % (t['name'], t['tid'], t['cpu_seconds']) for t in hot)))
+    if scheduler.missed:
+        sys.stderr.write("SYRUPY: Missed %d of %d polling ticks (interval %ss)\n" \
+            % (scheduler.missed, scheduler.ticks + scheduler.missed, poll_interval))
+    if tree:
+        for rollup in rollups:
+            if rollup.spawned or rollup.exited:
+                sys.stderr.write("SYRUPY: Process tree of %s: %d spawned, %d exited\n" \
+                    % (rollup.root, rollup.spawned, rollup.exited))
+
+    summary = {
+        'started': start_time.isoformat(' '),
+        'ended': datetime.datetime.now().isoformat(' '),
+        'interval': poll_interval,
+        'polls': polls,
+        'missed_polls': scheduler.missed,
+        'interrupted': interrupted,
+        'targets': {},
+    }
+    for idx, target in enumerate(targets):
+        entry = target.summary.as_dict()
+        entry['pid'] = target.pid
+        entry['command_pattern'] = target.command_pattern
+        if tree:
+            entry['tree'] = target.tree_summary.as_dict()
+            entry['tree']['spawned'] = rollups[idx].spawned
+            entry['tree']['exited'] = rollups[idx].exited
+        if target.leak_detector is not None:
+            entry['leak'] = target.leak_detector.verdict()
+        if threads:
+            entry['threads'] = target.thread_tracker.hot_threads()
+        summary['targets'][target.label] = entry
+    if summary_output is not None:
+        json.dump(summary, summary_output, indent=2, sort_keys=True, separators=(",", ": "))
+        summary_output.write("\n")
+        summary_output.flush()
+    return summary
 
 def profile_command(command,
         command_stdout,
@@ -304,12 +1751,22 @@ def profile_command(command,
         align=False,
         headers=True,
         flush_output=False,
-        debug_level=0):
+        debug_level=0,
+        backend="auto",
+        tree=False,
+        tree_output=None,
+        store=None,
+        summary_output=None,
+        metrics=(),
+        leak_detection=None,
+        threads=False,
+        thread_output=None):
     """
     Executes command `command`, redirecting its output stream to `command_stdout`
     and error stream to `command_stderr`. Polls the resulting process every
     `poll_interval` seconds, and writes the memory/cpu usage information to
-    `syrupy_output`.
+    `syrupy_output`. Returns the start and end times and the summary from
+    profile_process().
     """
     try:
         start_time = datetime.datetime.now()
@@ -318,7 +1775,7 @@ def profile_command(command,
                 stdout=command_stdout,
                 stderr=command_stderr,
                 env=os.environ)
-        profile_process(pid=proc.pid,
+        summary = profile_process(pid=proc.pid,
                 syrupy_output=syrupy_output,
                 raw_ps_log=raw_ps_log,
                 poll_interval=poll_interval,
@@ -330,10 +1787,22 @@ def profile_command(command,
                 align=align,
                 headers=headers,
                 flush_output=flush_output,
-                debug_level=debug_level)
+                debug_level=debug_level,
+                backend=backend,
+                tree=tree,
+                tree_output=tree_output,
+                store=store,
+                summary_output=summary_output,
+                metrics=metrics,
+                leak_detection=leak_detection,
+                threads=threads,
+                thread_output=thread_output)
+        if summary['interrupted'] and proc.poll() is None:
+            proc.terminate()
+            proc.wait()
         end_time = datetime.datetime.now()
-        return start_time, end_time
-    except Exception, e:
+        return start_time, end_time, summary
+    except Exception as e:
         sys.stderr.write("Failed to execute command: %s\n" % command)
         raise e
         sys.exit(1)
@@ -366,7 +1835,7 @@ def open_file(fpath, mode='r', replace=False, exit_on_fail=True):
                 else:
                     sys.stderr.write('File already exists: %s\n' % full_fpath)
                     sys.stderr.write('Overwrite (y/N)? ')
-                    ok = raw_input()
+                    ok = sys.stdin.readline()
                     if ok.lower().startswith('y'):
                         return open(full_fpath, mode)
                     else:
@@ -377,6 +1846,20 @@ def open_file(fpath, mode='r', replace=False, exit_on_fail=True):
             else:
                 return open(full_fpath, mode)
 
+LEAK_EXIT_STATUS = 3
+
+def parse_bytes(value):
+    """
+    Parses a byte count with an optional K, M or G (binary) suffix.
+    """
+    value = value.strip()
+    scale = 1
+    suffix = value[-1:].upper()
+    if suffix in ('K', 'M', 'G'):
+        scale = 1024 ** ('KMG'.index(suffix) + 1)
+        value = value[:-1]
+    return float(value) * scale
+
 _program_name = "Syrupy"
 _program_usage = '%prog [SYRUPY-OPTIONS] [COMMAND [COMMAND-OPTIONS] [COMMAND-ARGS]]'
 _program_version = '%s Version 1.4' % _program_name
@@ -394,6 +1877,10 @@ will be passed to COMMAND.
 _program_author = 'Jeet Sukumaran'
 _program_copyright = 'Copyright (C) 2009 Jeet Sukumaran.'
 
+def _interrupted(signum, frame):
+    # SIGTERM ends a run the way Ctrl-C does, so the summary is written
+    raise KeyboardInterrupt()
+
 def main():
     """
     Main CLI handler.
@@ -451,27 +1938,34 @@ no processes matching all the criteria are found. If no
 processes matching all the criteria are actually already running
 when Syrupy starts, then Syrupy exits immediately. Note that an
 instance of Syrupy automatically excludes its own process from
-being tracked by itself.
+being tracked by itself. When several PIDs and/or patterns are
+given, each is a separate target sampled from the same process
+listing, logged to '<TITLE>.<TARGET>.ps.log' (with '-S', rows are
+prefixed by the target name instead), and Syrupy runs until none
+of the targets has a process left.
         """
         )
     parser.add_option_group(process_opts)
 
     process_opts.add_option('-p', '--poll-pid', '--pid',
-            action='store',
+            action='append',
             dest='poll_pid',
             default=None,
             metavar='PID',
             type=int,
             help='ignore COMMAND if given, and poll external process with ' \
-                +'specified PID')
+                +'specified PID; may be given several times, each PID and ' \
+                +'-c pattern then being a separate target (given once each, ' \
+                +'-p and -c poll the PID only while its command matches)')
 
     process_opts.add_option('-c', '--poll-command',
-            action='store',
+            action='append',
             dest='poll_command',
             default=None,
             metavar='REG-EXP',
             help='ignore COMMAND if given, and poll external process with ' \
-                +'command matching specified regular expression pattern')
+                +'command matching specified regular expression pattern; ' \
+                +'may be given several times')
 
     polling_opts = OptionGroup(parser, 'Polling Regime')
     parser.add_option_group(polling_opts)
@@ -484,6 +1978,89 @@ being tracked by itself.
             type=float,
             help='polling interval in seconds (default=%default)')
 
+    polling_opts.add_option('--backend',
+            action='store',
+            dest='backend',
+            default='auto',
+            choices=['auto', 'proc', 'ps'],
+            metavar='BACKEND',
+            help="how to sample processes: 'proc' reads /proc directly, 'ps' " \
+                +"runs ps every poll, 'auto' uses /proc when available " \
+                +"(default=%default)")
+
+    polling_opts.add_option('--metrics',
+            action='store',
+            dest='metrics',
+            default='',
+            metavar='GROUP[,GROUP...]',
+            help='also sample these groups of /proc metrics, each adding ' \
+                +'columns (see --explain): ' \
+                +', '.join(group for group, columns in METRIC_GROUPS) \
+                +'; needs the proc backend')
+
+    polling_opts.add_option('--threads',
+            action='store_true',
+            dest='threads',
+            default=False,
+            help='also sample the CPU used by each thread over every ' \
+                +'interval, logging it by thread name, and summarize the ' \
+                +'hottest threads; needs the proc backend')
+
+    polling_opts.add_option('--tree',
+            action='store_true',
+            dest='tree',
+            default=False,
+            help='also track every descendant of the process (e.g. plugins ' \
+                +'spawned by the agent), and log per-tree totals of process ' \
+                +'count, CPU and memory to a separate file')
+
+    leak_opts = OptionGroup(parser, 'Leak Detection', """\
+Fits a least-squares trend to each target's total RSS over a sliding
+window, after a warmup period, and flags a leak when the growth rate is
+above the threshold with the required confidence over a full window. A
+target counts as leaking once any window has been flagged (when the
+warning is printed), even if growth later stops. The verdict is written
+to the summary, and Syrupy exits with status %d if a leak was found,
+including when the run is interrupted.
+        """ % LEAK_EXIT_STATUS
+        )
+    parser.add_option_group(leak_opts)
+
+    leak_opts.add_option('--leak-threshold',
+            action='store',
+            dest='leak_threshold',
+            default=None,
+            metavar='BYTES',
+            help='enable leak detection, flagging RSS growth above BYTES per ' \
+                +'hour (a K, M or G suffix is allowed)')
+
+    leak_opts.add_option('--leak-window',
+            action='store',
+            dest='leak_window',
+            type=float,
+            default=3600,
+            metavar='SECONDS',
+            help='length of the sliding window the trend is fitted over ' \
+                +'(default=%default)')
+
+    leak_opts.add_option('--leak-warmup',
+            action='store',
+            dest='leak_warmup',
+            type=float,
+            default=300,
+            metavar='SECONDS',
+            help='ignore samples taken this soon after the first one ' \
+                +'(default=%default)')
+
+    leak_opts.add_option('--leak-confidence',
+            action='store',
+            dest='leak_confidence',
+            type=float,
+            default=0.95,
+            metavar='P',
+            help='confidence required that growth exceeds the threshold ' \
+                +'(default=%default)')
+
     run_output_opts = OptionGroup(parser, 'Output Modes', """\
 By default, Syrupy redirects the standard output and standard error of COMMAND, as well
 as its own output, to log files. The following options allow you to change this behavior, either
@@ -519,6 +2096,30 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             default=False,
             help='force flushing of stream buffers after every write')
 
+    run_output_opts.add_option('--store',
+            action='store_true',
+            dest='store',
+            default=False,
+            help='write samples to a compact binary column store ' \
+                +"('<TITLE>.ps.col', see sample_store.py) instead of the " \
+                +'text log')
+
+    run_output_opts.add_option('--ring',
+            action='store',
+            dest='ring',
+            type=int,
+            default=0,
+            metavar='ROWS',
+            help='with --store, keep only the latest ROWS samples in a ' \
+                +'fixed-size file (default: keep all)')
+
+    run_output_opts.add_option('--no-summary',
+            action='store_true',
+            dest='suppress_summary',
+            default=False,
+            help="do not write the summary statistics ('<TITLE>.summary.json') " \
+                +'of each metric at exit')
+
     run_output_opts.add_option('--no-raw-process-log',
             action='store_true',
             dest='suppress_raw_process_log',
@@ -574,13 +2175,101 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
     else:
         base_title = opts.title
 
-    if opts.syrupy_in_front:
-        syrupy_output = sys.stdout
+    metrics = [group.strip() for group in opts.metrics.split(',') if group.strip()]
+    known = [group for group, columns in METRIC_GROUPS]
+    for group in metrics:
+        if group not in known:
+            sys.stderr.write("SYRUPY: Unknown metric group '%s' (choose from %s)\n" \
+                % (group, ", ".join(known)))
+            sys.exit(1)
+    if metrics and opts.backend == 'ps':
+        sys.stderr.write("SYRUPY: --metrics needs the proc backend\n")
+        sys.exit(1)
+    if opts.threads and opts.backend == 'ps':
+        sys.stderr.write("SYRUPY: --threads needs the proc backend\n")
+        sys.exit(1)
+
+    if opts.leak_threshold is None:
+        leak_detection = None
     else:
-        fname = base_title + ".ps.log"
-        if not opts.quiet:
-            sys.stderr.write("SYRUPY: Writing process resource usage samples to '%s'\n" % fname)
-        syrupy_output = open_file(fname, "w", replace=opts.replace)
+        try:
+            threshold = parse_bytes(opts.leak_threshold)
+        except ValueError:
+            sys.stderr.write("SYRUPY: Bad leak threshold: '%s'\n" % opts.leak_threshold)
+            sys.exit(1)
+        leak_detection = {
+            'threshold': threshold,
+            'window': opts.leak_window,
+            'warmup': opts.leak_warmup,
+            'confidence': opts.leak_confidence,
+        }
+
+    targets = []
+    poll_pids = opts.poll_pid or []
+    poll_commands = opts.poll_command or []
+    if len(poll_pids) == 1 and len(poll_commands) == 1:
+        # the PID, as long as its command matches
+        targets.append(Target(label=target_label(pid=poll_pids[0]), pid=poll_pids[0],
+                command_pattern=poll_commands[0]))
+        poll_pids = poll_commands = []
+    for pid in poll_pids:
+        targets.append(Target(label=target_label(pid=pid), pid=pid))
+    for pattern in poll_commands:
+        targets.append(Target(label=target_label(command_pattern=pattern),
+                command_pattern=pattern))
+    unique_labels(targets)
+
+    if opts.tree and [t for t in targets if t.pid is None]:
+        sys.stderr.write("SYRUPY: --tree needs a PID or COMMAND to use as the root\n")
+        sys.exit(1)
+
+    if len(targets) > 1:
+        suffixes = [(t, "." + t.label) for t in targets]
+    elif targets:
+        suffixes = [(targets[0], "")]
+    else:
+        suffixes = [(None, "")]
+
+    for target, suffix in suffixes:
+        store = None
+        if opts.store:
+            fname = base_title + suffix + ".ps.col"
+            if not opts.quiet:
+                sys.stderr.write("SYRUPY: Writing process resource usage samples to '%s'\n" % fname)
+            open_file(fname, "wb", replace=opts.replace).close()
+            store = sample_store.ColumnWriter(fname, capacity=opts.ring,
+                    extra_columns=[field for column, field in metric_columns(metrics)])
+            syrupy_output = None
+        elif opts.syrupy_in_front:
+            syrupy_output = sys.stdout
+        else:
+            fname = base_title + suffix + ".ps.log"
+            if not opts.quiet:
+                sys.stderr.write("SYRUPY: Writing process resource usage samples to '%s'\n" % fname)
+            syrupy_output = open_file(fname, "w", replace=opts.replace)
+        if not opts.tree:
+            tree_output = None
+        elif opts.syrupy_in_front:
+            tree_output = sys.stderr
+        else:
+            fname = base_title + suffix + ".tree.log"
+            if not opts.quiet:
+                sys.stderr.write("SYRUPY: Writing process tree totals to '%s'\n" % fname)
+            tree_output = open_file(fname, "w", replace=opts.replace)
+        if not opts.threads:
+            thread_output = None
+        elif opts.syrupy_in_front:
+            thread_output = sys.stderr
+        else:
+            fname = base_title + suffix + ".threads.log"
+            if not opts.quiet:
+                sys.stderr.write("SYRUPY: Writing per-thread CPU usage to '%s'\n" % fname)
+            thread_output = open_file(fname, "w", replace=opts.replace)
+        if target is not None:
+            target.output = syrupy_output
+            target.tree_output = tree_output
+            target.store = store
+            target.thread_output = thread_output
 
     if opts.suppress_raw_process_log:
         raw_ps_log = None
@@ -590,15 +2279,25 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             sys.stderr.write("SYRUPY: Writing raw process resource usage logs to '%s'\n" % fname)
         raw_ps_log = open_file(base_title + ".ps.raw", "w", replace=opts.replace)
 
-    if opts.poll_pid is not None or opts.poll_command is not None:
+    if opts.suppress_summary:
+        summary_output = None
+    elif opts.syrupy_in_front:
+        summary_output = sys.stderr
+    else:
+        fname = base_title + ".summary.json"
         if not opts.quiet:
-            if opts.poll_pid is not None:
-                sys.stderr.write("SYRUPY: sampling process %d\n" % opts.poll_pid)
-            else:
-                sys.stderr.write("SYRUPY: sampling process with command pattern '%s'\n" % opts.poll_command)
-        profile_process(pid=opts.poll_pid,
-                command_pattern=opts.poll_command,
-                syrupy_output=syrupy_output,
+            sys.stderr.write("SYRUPY: Writing summary statistics to '%s'\n" % fname)
+        summary_output = open_file(fname, "w", replace=opts.replace)
+
+    signal.signal(signal.SIGTERM, _interrupted)
+    if targets:
+        if not opts.quiet:
+            for target in targets:
+                if target.pid is not None:
+                    sys.stderr.write("SYRUPY: sampling process %d\n" % target.pid)
+                else:
+                    sys.stderr.write("SYRUPY: sampling process with command pattern '%s'\n" % target.command_pattern)
+        summary = profile_process(targets=targets,
                 raw_ps_log=raw_ps_log,
                 poll_interval=opts.poll_interval,
                 quit_poll_func=None,
@@ -609,7 +2308,14 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
                 align=opts.align,
                 headers=opts.headers,
                 flush_output=opts.flush_output,
-                debug_level=opts.debug)
+                debug_level=opts.debug,
+                backend=opts.backend,
+                tree=opts.tree,
+                show_label=opts.syrupy_in_front and len(targets) > 1,
+                summary_output=summary_output,
+                metrics=metrics,
+                leak_detection=leak_detection,
+                threads=opts.threads)
     else:
         command = args
         if not opts.quiet:
@@ -631,7 +2337,7 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             if not opts.quiet:
                 sys.stderr.write("SYRUPY: Redirecting command error stream to '%s'\n" % cerr)
             command_stderr = open_file(cerr, 'w', replace=opts.replace)
-        start_time, end_time = profile_command(command=command,
+        start_time, end_time, summary = profile_command(command=command,
                 command_stdout=command_stdout,
                 command_stderr=command_stderr,
                 syrupy_output=syrupy_output,
@@ -642,7 +2348,16 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
                 align=opts.align,
                 headers=opts.headers,
                 flush_output=opts.flush_output,
-                debug_level=opts.debug)
+                debug_level=opts.debug,
+                backend=opts.backend,
+                tree=opts.tree,
+                tree_output=tree_output,
+                store=store,
+                summary_output=summary_output,
+                metrics=metrics,
+                leak_detection=leak_detection,
+                threads=opts.threads,
+                thread_output=thread_output)
 
         if not opts.quiet:
                 final_run_report = []
@@ -655,6 +2370,18 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
                 report = "\n".join(final_run_report) + "\n"
                 sys.stderr.write(report)
 
+    leaks = [label for label, entry in sorted(summary['targets'].items())
+            if entry.get('leak', {}).get('status') == 'leak']
+    for label in leaks:
+        verdict = summary['targets'][label]['leak']
+        sys.stderr.write("SYRUPY: %s: memory leak suspected: RSS grew %.0f bytes/hour " \
+            "(confidence %.3f over %.0f seconds) as of %s\n" \
+            % (label, verdict['flagged_slope_bytes_per_hour'], verdict['flagged_confidence'],
+               verdict['window_seconds'],
+               datetime.datetime.fromtimestamp(verdict['first_flagged']).isoformat(' ')))
+    if leaks:
+        sys.exit(LEAK_EXIT_STATUS)
+
 if __name__ == '__main__':
     main()
 
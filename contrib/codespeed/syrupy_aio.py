@@ -0,0 +1,136 @@
+"""
+asyncio interface to syrupy, for harnesses that drive the agent while
+profiling it (Python 3.7+).
+
+Samples are read from /proc on the event loop itself -- a poll is a few
+file reads per process, well under a millisecond -- so no threads or
+child processes are involved and the harness's own I/O keeps running.
+
+    async for tick in sample(pids=[agent.pid], interval=0.5):
+        print(tick['pid%d' % agent.pid][0]['rss'])
+
+    async with Profiler(pids=[agent.pid], interval=0.5) as profiler:
+        await drive_agent()
+    print(profiler.summary())
+"""
+
+import asyncio
+
+import syrupy
+
+def _targets(pids, patterns):
+    targets = [syrupy.Target(label=syrupy.target_label(pid=pid), pid=pid)
+               for pid in pids]
+    targets += [syrupy.Target(label=syrupy.target_label(command_pattern=pattern),
+                              command_pattern=pattern)
+                for pattern in patterns]
+    if not targets:
+        raise ValueError('nothing to sample: give pids and/or patterns')
+    return syrupy.unique_labels(targets)
+
+async def sample(pids=(), patterns=(), interval=1.0, metrics=(), tree=False,
+                 until_gone=True):
+    """
+    Async generator that polls the processes given by `pids` and command
+    `patterns` every `interval` seconds and yields a dictionary mapping
+    each target label (as syrupy names its output files) to that poll's
+    records. Polls stay on a fixed grid of the loop's clock; polls the
+    consumer was too slow for are skipped. `metrics` and `tree` are as for
+    syrupy.profile_process(). Stops once no target has a process left,
+    unless `until_gone` is False.
+    """
+    targets = _targets(pids, patterns)
+    sampler = syrupy.ProcSampler(metrics=metrics)
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    try:
+        while True:
+            results = syrupy.poll_targets(targets, sampler=sampler, tree=tree)
+            if until_gone and not any(results):
+                return
+            yield dict((target.label, records) for target, records in zip(targets, results))
+            next_tick += interval
+            now = loop.time()
+            if now > next_tick:
+                next_tick += ((now - next_tick) // interval + 1) * interval
+            await asyncio.sleep(next_tick - now)
+    finally:
+        sampler.close()
+
+class Profiler(object):
+    """
+    Async context manager that samples in a background task for as long as
+    the block runs, keeping a syrupy.SampleSummary (and, with
+    `leak_detection`, a syrupy.LeakDetector) per target. `latest` holds the
+    last poll; with `keep`, every poll is kept in `history` as well.
+    """
+
+    def __init__(self, pids=(), patterns=(), interval=1.0, metrics=(), tree=False,
+                 leak_detection=None, keep=False):
+        self.pids = list(pids)
+        self.patterns = list(patterns)
+        self.interval = interval
+        self.metrics = list(metrics)
+        self.tree = tree
+        self.leak_detection = leak_detection
+        self.keep = keep
+        self.latest = None
+        self.history = []
+        self.polls = 0
+        self.summaries = {}
+        self.detectors = {}
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _run(self):
+        extra = [(field, field) for column, field in syrupy.metric_columns(self.metrics)]
+        async for tick in sample(self.pids, self.patterns, self.interval,
+                                 self.metrics, self.tree, until_gone=False):
+            for label, records in tick.items():
+                summary = self.summaries.get(label)
+                if summary is None:
+                    summary = self.summaries[label] = syrupy.SampleSummary(
+                        syrupy.SUMMARY_METRICS + extra)
+                    if self.leak_detection is not None:
+                        self.detectors[label] = syrupy.LeakDetector(**self.leak_detection)
+                for pinfo in records:
+                    summary.add_record(pinfo)
+                rss = sum(int(pinfo['rss']) for pinfo in records)
+                if label in self.detectors and rss > 0:
+                    self.detectors[label].add(records[0]['poll_epoch'], rss)
+            self.latest = tick
+            self.polls += 1
+            if self.keep:
+                self.history.append(tick)
+
+    async def stop(self):
+        """
+        Stops sampling; safe to call more than once.
+        """
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self):
+        """
+        Per-target statistics so far, shaped like the 'targets' part of
+        syrupy's summary.
+        """
+        targets = {}
+        for label, summary in self.summaries.items():
+            entry = summary.as_dict()
+            if label in self.detectors:
+                entry['leak'] = self.detectors[label].verdict()
+            targets[label] = entry
+        return {'interval': self.interval, 'polls': self.polls, 'targets': targets}
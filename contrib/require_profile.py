@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Summarize require() timings recorded by a bundle built with
+`contrib/zip.py --profile-require`.
+
+Both are experimental: the shim the bundle's modules carry has not yet
+been run under luvi, so its output format is only known from zip.py's
+REQUIRE_PROFILE_SHIM, not from a real agent run.
+
+Run the agent with VIRGO_REQUIRE_PROFILE=/path/to/profile (or capture its
+stderr), then:
+
+    python contrib/require_profile.py profile            # ranked report
+    python contrib/require_profile.py old new            # diff two builds
+
+Cumulative time is the wall time spent inside a module's require() calls,
+including the modules it loads; self time excludes those nested requires.
+When a profile holds several agent runs, times are averaged over the runs.
+"""
+import sys
+import json
+import posixpath
+
+from optparse import OptionParser
+
+MARKER = 'VIRGO_REQUIRE'
+
+class Call:
+    def __init__(self, run, id, parent, caller, name, start, stop):
+        self.run = run
+        self.id = id
+        self.parent = parent
+        self.module = resolve(caller, name)
+        self.cumulative = stop - start
+        self.children = 0
+
+def resolve(caller, name):
+    # Relative requires are resolved against the calling file, so the same
+    # module is counted once whoever loads it.
+    if name.startswith('./') or name.startswith('../'):
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(caller), name))
+    if name.endswith('.lua'):
+        name = name[:-len('.lua')]
+    if name.endswith('/init'):
+        name = name[:-len('/init')]
+    return name
+
+def parse(fp):
+    calls = {}
+    for line in fp:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 8 or fields[0] != MARKER:
+            continue
+        run, id, parent, caller, name = fields[1], int(fields[2]), int(fields[3]), fields[4], fields[5]
+        calls[(run, id)] = Call(run, id, parent, caller, name, float(fields[6]), float(fields[7]))
+    for call in calls.values():
+        parent = calls.get((call.run, call.parent))
+        if parent is not None:
+            parent.children += call.cumulative
+    return list(calls.values())
+
+def summarize(calls):
+    runs = len(set(call.run for call in calls)) or 1
+    modules = {}
+    for call in calls:
+        entry = modules.setdefault(call.module, {'calls': 0, 'self_ms': 0.0, 'cumulative_ms': 0.0})
+        entry['calls'] += 1
+        entry['self_ms'] += (call.cumulative - call.children) / 1e6 / runs
+        entry['cumulative_ms'] += call.cumulative / 1e6 / runs
+    return modules
+
+def load(path):
+    with open(path) as fp:
+        return summarize(parse(fp))
+
+def report(modules, sort, limit, out):
+    rows = sorted(modules.items(), key=lambda item: (-item[1][sort], item[0]))
+    out.write('%-50s %6s %12s %12s\n' % ('MODULE', 'CALLS', 'SELF(ms)', 'CUMUL(ms)'))
+    for name, entry in rows[:limit]:
+        out.write('%-50s %6d %12.3f %12.3f\n'
+                  % (name, entry['calls'], entry['self_ms'], entry['cumulative_ms']))
+
+def diff(old, new, sort):
+    rows = []
+    for name in set(old) | set(new):
+        before = old.get(name, {}).get(sort, 0.0)
+        after = new.get(name, {}).get(sort, 0.0)
+        rows.append((name, before, after, after - before))
+    rows.sort(key=lambda row: (-abs(row[3]), row[0]))
+    return rows
+
+def report_diff(rows, limit, out):
+    out.write('%-50s %12s %12s %12s\n' % ('MODULE', 'OLD(ms)', 'NEW(ms)', 'DELTA(ms)'))
+    for name, before, after, delta in rows[:limit]:
+        out.write('%-50s %12.3f %12.3f %+12.3f\n' % (name, before, after, delta))
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] PROFILE [NEW-PROFILE]')
+    parser.add_option('--sort', dest='sort', default='self', choices=['self', 'cumulative'],
+                      help="rank by 'self' or 'cumulative' time (default=%default)")
+    parser.add_option('-n', '--limit', dest='limit', type='int', default=30,
+                      help='number of modules to show (default=%default)')
+    parser.add_option('--json', dest='json', action='store_true', default=False,
+                      help='print machine-readable results instead of a table')
+    (options, args) = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.print_usage()
+        sys.exit(1)
+
+    sort = options.sort + '_ms'
+    profiles = [load(path) for path in args]
+    if len(profiles) == 1:
+        if options.json:
+            json.dump(profiles[0], sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            report(profiles[0], sort, options.limit, sys.stdout)
+    else:
+        rows = diff(profiles[0], profiles[1], sort)
+        if options.json:
+            json.dump([{'module': name, 'old_ms': before, 'new_ms': after, 'delta_ms': delta}
+                       for name, before, after, delta in rows], sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            report_diff(rows, options.limit, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,970 @@
 #!/usr/bin/env python
+import io
 import os
+import re
 import sys
+import time
+import json
+import struct
+import hashlib
 import zipfile
+import zlib
+import mmap
+import fnmatch
+import subprocess
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 class FileCtx:
-    def __init__(self, relpath, realpath):
+    def __init__(self, relpath, realpath, stat=None):
         self.relpath = relpath
         self.realpath = realpath
+        self.stat = stat
+
+DEFAULT_INCLUDE = ['*.lua']
+DEFAULT_EXCLUDE = ['.git', '.hg', '.svn']
+
+class ScanStats:
+    def __init__(self):
+        self.dirs = 0
+        self.files = 0
+        self.pruned = 0
+        self.matched = 0
+        self.seconds = 0.0
+
+    def merge(self, other):
+        self.dirs += other.dirs
+        self.files += other.files
+        self.pruned += other.pruned
+        self.matched += other.matched
+
+class TreeScanner:
+    # Collects bundle members with os.scandir (or the scandir backport),
+    # pruning excluded directories before descending into them. Patterns
+    # containing a '/' match the path relative to the root, others match
+    # the entry name.
+    def __init__(self, include=None, exclude=None, threads=None):
+        self.include = include or DEFAULT_INCLUDE
+        self.exclude = exclude if exclude is not None else DEFAULT_EXCLUDE
+        self.threads = threads
+        self.stats = ScanStats()
+
+    def _matches(self, patterns, name, relpath):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase('/' in pattern and relpath or name, pattern):
+                return True
+        return False
+
+    def _entries(self, path):
+        # Symlinked directories are skipped, as os.walk does: neither
+        # followed nor taken for files. So are directories that cannot
+        # be listed.
+        try:
+            names = list(scandir(path)) if scandir is not None else os.listdir(path)
+        except OSError:
+            return
+        if scandir is not None:
+            for entry in names:
+                is_dir = entry.is_dir()
+                if is_dir and entry.is_symlink():
+                    continue
+                yield entry.name, is_dir, entry
+        else:
+            for name in names:
+                full = os.path.join(path, name)
+                is_dir = os.path.isdir(full)
+                if is_dir and os.path.islink(full):
+                    continue
+                yield name, is_dir, None
+
+    def scan(self, root):
+        stats = ScanStats()
+        start = time.time()
+        found = []
+        pending = ['']
+        while pending:
+            reldir = pending.pop()
+            stats.dirs += 1
+            for name, is_dir, entry in self._entries(os.path.join(root, reldir)):
+                relpath = os.path.join(reldir, name)
+                match_path = relpath.replace(os.sep, '/')
+                if self._matches(self.exclude, name, match_path):
+                    stats.pruned += 1
+                    continue
+                if is_dir:
+                    pending.append(relpath)
+                    continue
+                stats.files += 1
+                if not self._matches(self.include, name, match_path):
+                    continue
+                realpath = os.path.join(root, relpath)
+                st = entry.stat() if entry is not None else os.stat(realpath)
+                found.append(FileCtx(relpath, realpath, st))
+        stats.matched = len(found)
+        stats.seconds = time.time() - start
+        return found, stats
+
+    def scan_all(self, roots):
+        # Results come back in root order, so later roots still override
+        # earlier ones for the same relpath.
+        start = time.time()
+        if self.threads and self.threads > 1 and len(roots) > 1:
+            pool = ThreadPool(min(self.threads, len(roots)))
+            try:
+                results = pool.map(self.scan, roots)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.scan(root) for root in roots]
+        self.stats = ScanStats()
+        for _, stats in results:
+            self.stats.merge(stats)
+        self.stats.seconds = time.time() - start
+        return [found for found, _ in results]
+
+_LUA_TOKEN = re.compile(br'''
+    (?P<space>[ \t\r\f\v]+)
+  | (?P<newline>\n)
+  | (?P<longcomment>--\[(?P<lcq>=*)\[)
+  | (?P<comment>--[^\n]*)
+  | (?P<longstring>\[(?P<lsq>=*)\[)
+  | (?P<string>"(?:\\z\s*|\\.|\\\n|[^"\\\n])*"|'(?:\\z\s*|\\.|\\\n|[^'\\\n])*')
+  | (?P<number>\.?[0-9](?:[eEpP][+-]|[0-9A-Za-z_.])*)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>.)
+''', re.VERBOSE | re.DOTALL)
+
+_LUA_WORD = re.compile(br'[A-Za-z0-9_]')
+
+# Operator characters that would fuse into a different token if the
+# whitespace between them were removed.
+_LUA_FUSING = set([b'--', b'..', b'==', b'<=', b'>=', b'~=', b'<<', b'>>',
+                   b'//', b'::', b'[[', b'[='])
+
+def _lua_needs_space(prev, prev_kind, tok):
+    a, b = prev[-1:], tok[:1]
+    if _LUA_WORD.match(a) and _LUA_WORD.match(b):
+        return True
+    if (a == b'.' or prev_kind == 'number') and (b == b'.' or _LUA_WORD.match(b)):
+        return True
+    return a + b in _LUA_FUSING
+
+def minify_lua(source):
+    # Drops comments and redundant whitespace but keeps every newline, so a
+    # line number in a crash trace still points at the original source line.
+    out = []
+    pos = 0
+    if source.startswith(b'#'):
+        pos = source.find(b'\n')
+        if pos < 0:
+            return source
+        out.append(source[:pos])
+    prev = prev_kind = None
+    gap = False
+    while pos < len(source):
+        m = _LUA_TOKEN.match(source, pos)
+        kind = m.lastgroup
+        if kind in ('longcomment', 'longstring'):
+            close = b']' + m.group('lcq' if kind == 'longcomment' else 'lsq') + b']'
+            end = source.find(close, m.end())
+            end = len(source) if end < 0 else end + len(close)
+        else:
+            end = m.end()
+        text = source[pos:end]
+        pos = end
+        if kind == 'space' or kind == 'comment':
+            gap = True
+        elif kind == 'newline' or kind == 'longcomment':
+            newlines = text.count(b'\n')
+            if newlines:
+                out.append(b'\n' * newlines)
+                prev = None
+            gap = True
+        else:
+            if prev is not None and gap and _lua_needs_space(prev, prev_kind, text):
+                out.append(b' ')
+            out.append(text)
+            prev, prev_kind = text, kind
+            gap = False
+            if kind == 'longstring' and b'\n' in text:
+                prev = None
+    return b''.join(out)
+
+# Prepended to line 1 of every module in a --profile-require bundle. It
+# wraps the module's own require() and appends one record per call to
+# $VIRGO_REQUIRE_PROFILE (or stderr):
+#
+#   VIRGO_REQUIRE <run> <id> <parent id> <calling file> <name> <start ns> <stop ns>
+#
+# It must stay on one line so the module's line numbers do not move.
+# Experimental: the shim has not yet been run under luvi, only generated.
+REQUIRE_PROFILE_SHIM = ' '.join('''
+local require = (function(req, file)
+  if type(req) ~= 'function' or type(_G) ~= 'table' then return req end
+  local p = rawget(_G, '__virgo_require_profile')
+  if not p then
+    local now = function() return os.clock() * 1e9 end
+    local ok, uv = pcall(req, 'uv')
+    if ok and type(uv) == 'table' and uv.hrtime then now = uv.hrtime end
+    local path = os.getenv('VIRGO_REQUIRE_PROFILE')
+    p = { now = now, out = path and io.open(path, 'a') or io.stderr,
+          stack = {}, id = 0, run = string.format('%.0f', now()) }
+    rawset(_G, '__virgo_require_profile', p)
+  end
+  local unpack = unpack or table.unpack
+  local function pack(...) return { n = select('#', ...), ... } end
+  return function(name, ...)
+    p.id = p.id + 1
+    local id, stack = p.id, p.stack
+    local parent = stack[#stack] or 0
+    stack[#stack + 1] = id
+    local start = p.now()
+    local res = pack(pcall(req, name, ...))
+    local stop = p.now()
+    stack[#stack] = nil
+    p.out:write(string.format('VIRGO_REQUIRE\\t%s\\t%d\\t%d\\t%s\\t%s\\t%.0f\\t%.0f\\n',
+      p.run, id, parent, file, tostring(name), start, stop))
+    p.out:flush()
+    if not res[1] then error(res[2], 0) end
+    return unpack(res, 2, res.n)
+  end
+end)(require, @MODULE_PATH@);
+'''.split())
+
+def profile_require(data, relpath):
+    shim = REQUIRE_PROFILE_SHIM.replace('@MODULE_PATH@', json.dumps(relpath.replace(os.sep, '/')))
+    shim = shim.encode('utf-8')
+    if data.startswith(b'#'):
+        eol = data.find(b'\n') + 1 or len(data)
+        return data[:eol] + shim + b' ' + data[eol:]
+    return shim + b' ' + data
+
+def _read(realpath, minify=False, profile=None):
+    with open(realpath, 'rb') as fp:
+        data = fp.read()
+    if minify:
+        data = minify_lua(data)
+    if profile is not None:
+        data = profile_require(data, profile)
+    return data
+
+def _deflate(args):
+    # Runs in a worker process; mirrors what ZipFile.write does for a
+    # ZIP_DEFLATED member so the bytes come out the same. With a store
+    # ratio, members that deflate no smaller than that fraction of their
+    # size are stored instead and cost nothing to inflate at load time.
+    realpath, minify, store_ratio, level, profile = args
+    data = _read(realpath, minify, profile)
+    crc = zlib.crc32(data) & 0xffffffff
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    cmpr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = cmpr.compress(data) + cmpr.flush()
+    if store_ratio is not None and len(compressed) >= store_ratio * len(data):
+        return crc, len(data), data, zipfile.ZIP_STORED
+    return crc, len(data), compressed, zipfile.ZIP_DEFLATED
+
+def sign_digest(digest, key, passin=None):
+    # Equivalent to `openssl dgst -sha256 -sign KEY` on the original bytes,
+    # but works from the digest so the bundle never has to be reread.
+    args = ['openssl', 'pkeyutl', '-sign', '-inkey', key,
+            '-pkeyopt', 'digest:sha256']
+    if passin:
+        args += ['-passin', passin]
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    signature = p.communicate(digest)[0]
+    if p.returncode != 0:
+        raise RuntimeError('openssl failed to sign digest (exit %d)' % p.returncode)
+    return signature
+
+def verify_digest(digest, signature, key):
+    # KEY may be a PEM public key or a certificate carrying one.
+    with open(key, 'rb') as fp:
+        certin = b'CERTIFICATE' in fp.read()
+    args = ['openssl', 'pkeyutl', '-verify', '-inkey', key,
+            certin and '-certin' or '-pubin', '-sigfile', signature,
+            '-pkeyopt', 'digest:sha256']
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    p.communicate(digest)
+    return p.returncode == 0
+
+class HashingWriter:
+    # Forward-only output stream for ZipFile: it can be a pipe or stdout,
+    # and the SHA-256 of everything written is computed on the way out.
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.offset += len(data)
+        self.fp.write(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fp.flush()
+
+class BundleCache:
+    # Persistent store of compressed members keyed by the SHA-256 of the
+    # source file. A stat index (size, mtime, inode) lets unchanged files
+    # skip hashing too, so a rebuild only reads what was edited.
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.index = {}
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as fp:
+                self.index = json.load(fp)
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def digest(self, ctx):
+        realpath = os.path.abspath(ctx.realpath)
+        st = ctx.stat or os.stat(realpath)
+        key = [st.st_size, st.st_mtime, st.st_ino]
+        entry = self.index.get(realpath)
+        if entry is not None and entry[:3] == key:
+            digest = entry[3]
+        else:
+            with open(realpath, 'rb') as fp:
+                digest = hashlib.sha256(fp.read()).hexdigest()
+        self.seen[realpath] = key + [digest]
+        return digest
+
+    def get(self, digest):
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        crc, size, method = struct.unpack('<IIH', data[:10])
+        return crc, size, data[10:], method
+
+    def put(self, digest, result):
+        path = self._object_path(digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        crc, size, data, method = result
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(struct.pack('<IIH', crc, size, method))
+            fp.write(data)
+        os.rename(tmp, path)
+
+    def save(self):
+        # Only files from this build are kept in the stat index.
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.seen, fp)
+        os.rename(tmp, self.index_path)
+
+# Embedded module index: a stored member written after all the others and
+# located through the zip comment, so a loader finds any module with one
+# read of the end record and a binary search instead of parsing the
+# central directory.
+#
+#   header   magic 'VGIX', u16 version, u16 reserved, u32 count, u32 names offset
+#   records  count x (u32 name offset, u16 name length, u16 method,
+#                     u32 crc, u32 compressed size, u32 size, u32 header offset)
+#   names    concatenated UTF-8 module names, records sorted by name
+INDEX_NAME = '.virgo-index'
+INDEX_MAGIC = b'VGIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sHHII')
+INDEX_RECORD = struct.Struct('<IHHIIII')
+INDEX_COMMENT = struct.Struct('<4sI')
+
+def module_name(relpath):
+    name = os.path.splitext(relpath)[0].replace(os.sep, '/').replace('/', '.')
+    if name.endswith('.init'):
+        name = name[:-len('.init')]
+    return name
+
+def pack_index(entries):
+    # entries: (module name, zinfo) pairs
+    entries = sorted((name.encode('utf-8'), zinfo) for name, zinfo in entries)
+    names_offset = INDEX_HEADER.size + INDEX_RECORD.size * len(entries)
+    records = []
+    names = []
+    name_offset = 0
+    for name, zinfo in entries:
+        records.append(INDEX_RECORD.pack(name_offset, len(name), zinfo.compress_type,
+                                         zinfo.CRC, zinfo.compress_size,
+                                         zinfo.file_size, zinfo.header_offset))
+        names.append(name)
+        name_offset += len(name)
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, len(entries), names_offset)
+    return header + b''.join(records) + b''.join(names)
+
+class IndexEntry:
+    def __init__(self, name, method, crc, compress_size, file_size, header_offset, data_offset):
+        self.name = name
+        self.method = method
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.header_offset = header_offset
+        self.data_offset = data_offset
+
+class BundleIndex:
+    # Reads a bundle through its embedded index, straight out of an mmap.
+    def __init__(self, path):
+        self.fp = open(path, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = self._locate()
+        magic, version, _, self.count, self.names_offset = \
+            INDEX_HEADER.unpack_from(self.map, self.base)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('%s: unsupported bundle index' % path)
+
+    def _locate(self):
+        # The end record is the last 22 bytes plus our fixed-size comment.
+        end = len(self.map) - 22 - INDEX_COMMENT.size
+        if end < 0 or self.map[end:end + 4] != b'PK\x05\x06':
+            raise ValueError('bundle has no index comment')
+        magic, offset = INDEX_COMMENT.unpack_from(self.map, end + 22)
+        if magic != INDEX_MAGIC:
+            raise ValueError('bundle has no index comment')
+        return offset
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def _record(self, i):
+        return INDEX_RECORD.unpack_from(self.map, self.base + INDEX_HEADER.size + INDEX_RECORD.size * i)
+
+    def _name(self, record):
+        start = self.base + self.names_offset + record[0]
+        return self.map[start:start + record[1]]
+
+    def _find(self, name):
+        key = name.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            current = self._name(record)
+            if current == key:
+                return record
+            if current < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def names(self):
+        return [self._name(self._record(i)).decode('utf-8') for i in range(self.count)]
+
+    def lookup(self, name):
+        record = self._find(name)
+        if record is None:
+            raise KeyError(name)
+        _, _, method, crc, compress_size, file_size, header_offset = record
+        name_len, extra_len = struct.unpack_from('<HH', self.map, header_offset + 26)
+        return IndexEntry(name, method, crc, compress_size, file_size, header_offset,
+                          header_offset + 30 + name_len + extra_len)
+
+    def read(self, name):
+        entry = self.lookup(name)
+        data = self.map[entry.data_offset:entry.data_offset + entry.compress_size]
+        if entry.method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        if zlib.crc32(data) & 0xffffffff != entry.crc:
+            raise ValueError('CRC mismatch for %s' % name)
+        return data
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Delta between two bundles: the new bundle is described as a list of ops
+# that either copy a byte range from the old bundle or take the next bytes
+# from a zlib-compressed literal payload. Compressed members that did not
+# change are copied, so the delta carries only new member data, local
+# headers and the central directory.
+#
+#   'VGDL', u16 version, u32 header length, JSON header, payload
+DELTA_MAGIC = b'VGDL'
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct('<4sHI')
+
+def _members(data):
+    members = {}
+    for zinfo in zipfile.ZipFile(io.BytesIO(data)).infolist():
+        name_len, extra_len = struct.unpack_from('<HH', data, zinfo.header_offset + 26)
+        data_offset = zinfo.header_offset + 30 + name_len + extra_len
+        members[zinfo.filename] = (zinfo, data_offset)
+    return members
+
+def make_delta(old, new):
+    old_members = _members(old)
+    new_members = _members(new)
+    by_content = {}
+    for zinfo, offset in old_members.values():
+        key = (zinfo.CRC, zinfo.compress_size, zinfo.compress_type)
+        by_content.setdefault(key, []).append(offset)
+
+    ops = []
+    literal = []
+    def emit_literal(start, end):
+        if end > start:
+            literal.append(new[start:end])
+            if ops and ops[-1][0] == 'L':
+                ops[-1][1] += end - start
+            else:
+                ops.append(['L', end - start])
+
+    def emit_copy(offset, size):
+        if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == offset:
+            ops[-1][2] += size
+        else:
+            ops.append(['C', offset, size])
+
+    summary = {'added': [], 'replaced': [], 'deleted': [], 'unchanged': 0}
+    pos = 0
+    for zinfo, offset in sorted(new_members.values(), key=lambda m: m[1]):
+        chunk = new[offset:offset + zinfo.compress_size]
+        source = None
+        for candidate in by_content.get((zinfo.CRC, zinfo.compress_size, zinfo.compress_type), []):
+            if old[candidate:candidate + zinfo.compress_size] == chunk:
+                source = candidate
+                break
+        if zinfo.filename not in old_members:
+            summary['added'].append(zinfo.filename)
+        elif source is None:
+            summary['replaced'].append(zinfo.filename)
+        else:
+            summary['unchanged'] += 1
+        if source is None:
+            emit_literal(pos, offset + zinfo.compress_size)
+        else:
+            emit_literal(pos, offset)
+            emit_copy(source, zinfo.compress_size)
+        pos = offset + zinfo.compress_size
+    emit_literal(pos, len(new))
+    summary['deleted'] = sorted(set(old_members) - set(new_members))
+
+    header = json.dumps({
+        'old_sha256': hashlib.sha256(old).hexdigest(),
+        'new_sha256': hashlib.sha256(new).hexdigest(),
+        'new_size': len(new),
+        'members': summary,
+        'ops': ops,
+    }, sort_keys=True).encode('utf-8')
+    payload = zlib.compress(b''.join(literal), 9)
+    return DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, len(header)) + header + payload
+
+def read_delta_header(delta):
+    magic, version, length = DELTA_HEADER.unpack_from(delta, 0)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise ValueError('unsupported delta')
+    start = DELTA_HEADER.size
+    return json.loads(delta[start:start + length].decode('utf-8')), start + length
+
+def apply_delta(old, delta):
+    header, start = read_delta_header(delta)
+    if hashlib.sha256(old).hexdigest() != header['old_sha256']:
+        raise ValueError('delta does not apply to this bundle')
+    payload = zlib.decompress(delta[start:])
+    out = []
+    pos = 0
+    for op in header['ops']:
+        if op[0] == 'C':
+            out.append(old[op[1]:op[1] + op[2]])
+        else:
+            out.append(payload[pos:pos + op[1]])
+            pos += op[1]
+    new = b''.join(out)
+    if len(new) != header['new_size'] or hashlib.sha256(new).hexdigest() != header['new_sha256']:
+        raise ValueError('rebuilt bundle does not match the delta checksum')
+    return new
+
+def _read_file(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+def _write_file(path, data):
+    with open(path, 'wb') as fp:
+        fp.write(data)
 
 class VirgoZip(zipfile.ZipFile):
-    def __init__(self, roots, out):
+    def __init__(self, roots, out, jobs=None, cache=None, minify=False, index=False,
+                 store_ratio=None, dedup=False, scanner=None, level=None,
+                 profile_require=False):
         zipfile.ZipFile.__init__(self, out, 'w', zipfile.ZIP_DEFLATED)
         self.roots = roots
         self.files = {}
+        self.scanner = scanner or TreeScanner()
+        self.jobs = jobs
+        self.cache = cache
+        self.minify = minify
+        self.index = index or dedup
+        self.store_ratio = store_ratio
+        self.dedup = dedup
+        self.level = level
+        self.profile_require = profile_require
+        self.aliases = {}
+        self.contents = {}
+        self.log = sys.stdout
+        self.source_bytes = 0
+        self.stored_bytes = 0
+        self.stored_members = 0
+        self.dedup_bytes = 0
 
     def run(self):
-        for root in self.roots:
-            for r, dirs, files in os.walk(root):
-                for f in files:
-                    if not f.endswith('.lua'):
-                        continue
-                    realpath = os.path.join(r, f)
-                    relpath = os.path.relpath(realpath, root)
-                    if relpath:
-                        fctx = FileCtx(relpath, realpath)
-                        self.files[fctx.relpath] = fctx
+        for found in self.scanner.scan_all(self.roots):
+            for fctx in found:
+                self.files[fctx.relpath] = fctx
+        stats = self.scanner.stats
+        self._log('Scanned %d dirs, %d files (%d pruned), %d matched in %.3fs'
+                  % (stats.dirs, stats.files, stats.pruned, stats.matched, stats.seconds))
+
+    def _log(self, msg):
+        self.log.write(msg + '\n')
 
     def _write(self, ctx):
-        print('Adding: ' + ctx.relpath)
-        self.write(ctx.realpath, ctx.relpath) 
+        self._log('Adding: ' + ctx.relpath)
+        self.write(ctx.realpath, ctx.relpath)
+
+    def _zinfo(self, ctx):
+        # Same fields ZipFile.write derives, but from the scanner's stat.
+        st = ctx.stat or os.stat(ctx.realpath)
+        arcname = os.path.normpath(os.path.splitdrive(ctx.relpath)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.file_size = st.st_size
+        zinfo.compress_type = self.compression
+        zinfo.flag_bits = 0x00
+        return zinfo
+
+    def _write_raw(self, zinfo, data):
+        # Append a member whose CRC, sizes and compressed bytes are already
+        # known, so the local header is written once and never revisited.
+        zip64 = self._allowZip64 and zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.write(data)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+        self.start_dir = self.fp.tell()
+
+    def _add(self, ctx, result):
+        crc, size, data, method = result
+        if self.minify:
+            # aliases are counted too, so the totals cover the same files
+            # as the summary's file count
+            self.source_bytes += (ctx.stat or os.stat(ctx.realpath)).st_size
+            self.stored_bytes += size
+        if self.dedup:
+            key = (crc, size, method, hashlib.sha256(data).digest())
+            if key in self.contents:
+                # Only the index knows about aliases; the central directory
+                # holds each distinct member once.
+                self._log('Aliasing: %s -> %s' % (ctx.relpath, self.contents[key]))
+                self.aliases[ctx.relpath] = self.contents[key]
+                self.dedup_bytes += len(data)
+                return
+            self.contents[key] = ctx.relpath
+        self._log('Adding: ' + ctx.relpath)
+        zinfo = self._zinfo(ctx)
+        zinfo.compress_type = method
+        if method == zipfile.ZIP_STORED:
+            self.stored_members += 1
+        if self.minify:
+            self._log('  minified %d -> %d bytes (saved %d)'
+                      % (zinfo.file_size, size, zinfo.file_size - size))
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        self._write_raw(zinfo, data)
+
+    def _profile_name(self, ctx):
+        # package.lua is read as metadata by lit, so it is left alone.
+        if not self.profile_require or ctx.relpath == 'package.lua':
+            return None
+        return ctx.relpath
+
+    def _precompressed(self):
+        # Whether members must go through _deflate/_write_raw rather than
+        # ZipFile.write.
+        return (self.jobs and self.jobs > 1) or self.minify or self.dedup \
+            or self.store_ratio is not None or self.level is not None \
+            or self.profile_require or not hasattr(self.fp, 'seek')
+
+    def _compress(self, ctxs):
+        tasks = [(ctx.realpath, self.minify, self.store_ratio, self.level,
+                  self._profile_name(ctx)) for ctx in ctxs]
+        if not self.jobs or self.jobs <= 1:
+            for task in tasks:
+                yield _deflate(task)
+            return
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            chunksize = max(1, len(tasks) // (self.jobs * 4))
+            for result in pool.imap(_deflate, tasks, chunksize):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def _save_cached(self, ctxs):
+        # Minified, possibly-stored or non-default-level members are cached
+        # separately from plain deflated ones.
+        suffix = self.minify and '.min' or ''
+        if self.store_ratio is not None:
+            suffix += '.s%g' % self.store_ratio
+        if self.level is not None:
+            suffix += '.l%d' % self.level
+        digests = []
+        for ctx in ctxs:
+            digest = self.cache.digest(ctx) + suffix
+            if self._profile_name(ctx) is not None:
+                # the shim embeds the member's path
+                digest += '.p' + hashlib.sha256(ctx.relpath.encode('utf-8')).hexdigest()[:16]
+            digests.append(digest)
+        results = {}
+        misses = {}
+        for ctx, digest in zip(ctxs, digests):
+            if digest in results or digest in misses:
+                continue
+            result = self.cache.get(digest)
+            if result is None:
+                misses[digest] = ctx
+            else:
+                results[digest] = result
+        pending = sorted(misses.items())
+        for (digest, ctx), result in zip(pending, self._compress([c for _, c in pending])):
+            self.cache.put(digest, result)
+            results[digest] = result
+        for ctx, digest in zip(ctxs, digests):
+            self._add(ctx, results[digest])
+        self.cache.save()
+
+    def _write_index(self):
+        modules = {}
+        for relpath in sorted(self.files):
+            name = module_name(relpath)
+            # foo.lua wins over foo/init.lua, as in Lua's own search order
+            if name in modules and os.path.basename(relpath) == 'init.lua':
+                continue
+            member = self.aliases.get(relpath, relpath)
+            modules[name] = self.getinfo(member.replace(os.sep, '/'))
+        data = pack_index(modules.items())
+        zinfo = zipfile.ZipInfo(INDEX_NAME, (1980, 1, 1, 0, 0, 0))
+        zinfo.external_attr = 0o644 << 16
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        zinfo.file_size = zinfo.compress_size = len(data)
+        self._write_raw(zinfo, data)
+        self.comment = INDEX_COMMENT.pack(INDEX_MAGIC, zinfo.header_offset + len(zinfo.FileHeader()))
+        self._log('Indexed %d modules' % len(modules))
 
     def save(self):
-        [ self._write(ctx) for _, ctx in sorted(self.files.items()) ]
+        ctxs = [ctx for _, ctx in sorted(self.files.items())]
+        if self.cache is not None:
+            self._save_cached(ctxs)
+        elif self._precompressed():
+            for ctx, result in zip(ctxs, self._compress(ctxs)):
+                self._add(ctx, result)
+        else:
+            [ self._write(ctx) for ctx in ctxs ]
+        if self.index:
+            self._write_index()
+        if self.dedup:
+            self._log('Deduplicated %d files (saved %d bytes)'
+                      % (len(self.aliases), self.dedup_bytes))
+        if self.store_ratio is not None:
+            self._log('Stored %d members uncompressed' % self.stored_members)
+        if self.minify:
+            self._log('Minified %d files: %d -> %d bytes (saved %d)'
+                      % (len(ctxs), self.source_bytes, self.stored_bytes,
+                         self.source_bytes - self.stored_bytes))
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] OUT ROOT [ROOT ...]')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='compress members in a pool of JOBS processes '
+                           '(0 = one per CPU); output matches the serial build')
+    parser.add_option('--include', dest='include', action='append', default=None,
+                      metavar='GLOB',
+                      help='collect files matching GLOB (repeatable; default: %s)'
+                           % ', '.join(DEFAULT_INCLUDE))
+    parser.add_option('--exclude', dest='exclude', action='append', default=None,
+                      metavar='GLOB',
+                      help='skip files and prune directories matching GLOB '
+                           '(repeatable; %s are always skipped)' % ', '.join(DEFAULT_EXCLUDE))
+    parser.add_option('--scan-threads', dest='scan_threads', type='int', default=None,
+                      help='scan up to this many roots concurrently')
+    parser.add_option('-l', '--level', dest='level', type='int', default=None,
+                      help='deflate compression level, 0-9 (default: zlib default)')
+    parser.add_option('--cache', dest='cache', default=None, metavar='DIR',
+                      help='reuse compressed members from DIR for files whose '
+                           'content has not changed, and store new ones there')
+    parser.add_option('--minify', dest='minify', action='store_true', default=False,
+                      help='strip comments and redundant whitespace from Lua '
+                           'sources; line numbers are preserved')
+    parser.add_option('--index', dest='index', action='store_true', default=False,
+                      help='embed a sorted module index (%s) located through '
+                           'the zip comment' % INDEX_NAME)
+    parser.add_option('--dedup', dest='dedup', action='store_true', default=False,
+                      help='store identical files once and record the other '
+                           'paths as aliases in the index (implies --index)')
+    parser.add_option('--store-ratio', dest='store_ratio', type='float', default=None,
+                      metavar='RATIO',
+                      help='store members uncompressed when deflate does not '
+                           'shrink them below RATIO of their size (e.g. 0.9)')
+    parser.add_option('--profile-require', dest='profile_require', action='store_true',
+                      default=False,
+                      help='experimental: build a profiling variant whose modules '
+                           'log every require() call to $VIRGO_REQUIRE_PROFILE (see '
+                           'contrib/require_profile.py)')
+    parser.add_option('--show-index', dest='show_index', action='store_true', default=False,
+                      help='list the embedded index of the bundles given as '
+                           'arguments and exit')
+    parser.add_option('--make-delta', dest='make_delta', nargs=3, default=None,
+                      metavar='OLD NEW DELTA',
+                      help='write a delta that turns bundle OLD into bundle NEW '
+                           '(signed when --sign is given) and exit')
+    parser.add_option('--apply-delta', dest='apply_delta', nargs=3, default=None,
+                      metavar='OLD DELTA OUT',
+                      help='rebuild a bundle from OLD and DELTA, checking its '
+                           'SHA-256 (and signature with --verify), and exit')
+    parser.add_option('--verify', dest='verify', default=None, metavar='PUBKEY',
+                      help='public key or certificate to check a delta signature')
+    parser.add_option('--stream', dest='stream', action='store_true', default=False,
+                      help='write the bundle in one forward-only pass (OUT may be '
+                           '"-" for stdout) and print its SHA-256')
+    parser.add_option('--sign', dest='sign', default=None, metavar='KEY',
+                      help='write a detached SHA-256 signature made with private '
+                           'KEY (implies --stream)')
+    parser.add_option('--sig', dest='sig', default=None, metavar='PATH',
+                      help='where to write the signature (default: OUT.sig)')
+    parser.add_option('--passin', dest='passin', default=None, metavar='ARG',
+                      help='openssl -passin argument for KEY (e.g. env:VAR)')
+    (options, args) = parser.parse_args()
+    if options.show_index:
+        for path in args:
+            with BundleIndex(path) as index:
+                for name in index.names():
+                    entry = index.lookup(name)
+                    print('%-40s %10d %8d %8d %08x %d' % (name, entry.data_offset,
+                          entry.compress_size, entry.file_size, entry.crc, entry.method))
+        return
+    if options.make_delta:
+        old, new, out = options.make_delta
+        delta = make_delta(_read_file(old), _read_file(new))
+        _write_file(out, delta)
+        header = read_delta_header(delta)[0]
+        members = header['members']
+        print('Delta: %d bytes for a %d byte bundle (%d added, %d replaced, '
+              '%d deleted, %d unchanged)' % (len(delta), header['new_size'],
+              len(members['added']), len(members['replaced']),
+              len(members['deleted']), members['unchanged']))
+        if options.sign:
+            sig = options.sig or out + '.sig'
+            _write_file(sig, sign_digest(hashlib.sha256(delta).digest(),
+                                         options.sign, options.passin))
+            print('Signature: %s' % sig)
+        return
+    if options.apply_delta:
+        old, delta_path, out = options.apply_delta
+        delta = _read_file(delta_path)
+        if options.verify:
+            sig = options.sig or delta_path + '.sig'
+            if not verify_digest(hashlib.sha256(delta).digest(), sig, options.verify):
+                sys.stderr.write('Signature verification failed: %s\n' % sig)
+                sys.exit(1)
+        try:
+            new = apply_delta(_read_file(old), delta)
+        except ValueError as e:
+            sys.stderr.write('%s\n' % e)
+            sys.exit(1)
+        _write_file(out, new)
+        print('Rebuilt: %s (%d bytes)' % (out, len(new)))
+        return
+    if len(args) < 2:
+        parser.error('an output file and at least one root are required')
+    if options.sign:
+        options.stream = True
+    if options.sign and not options.sig:
+        if args[0] == '-':
+            parser.error('--sig is required when writing to stdout')
+        options.sig = args[0] + '.sig'
+
+    jobs = options.jobs
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+
+    cache = None
+    if options.cache:
+        cache = BundleCache(options.cache)
+
+    out = args[0]
+    log = sys.stdout
+    if options.stream:
+        if out == '-':
+            out = HashingWriter(getattr(sys.stdout, 'buffer', sys.stdout))
+            log = sys.stderr
+        else:
+            out = HashingWriter(open(out, 'wb'))
+
+    scanner = TreeScanner(options.include, DEFAULT_EXCLUDE + (options.exclude or []),
+                          options.scan_threads)
+
+    z = VirgoZip(args[1:], out, jobs=jobs, scanner=scanner, cache=cache, minify=options.minify,
+                 index=options.index, store_ratio=options.store_ratio,
+                 dedup=options.dedup, level=options.level,
+                 profile_require=options.profile_require)
+    z.log = log
+    z.run()
+    z.save()
+    z.close()
+
+    if options.stream:
+        out.flush()
+        if out.fp is not getattr(sys.stdout, 'buffer', sys.stdout):
+            out.fp.close()
+        log.write('SHA-256: %s\n' % out.sha256.hexdigest())
+        if options.sign:
+            with open(options.sig, 'wb') as fp:
+                fp.write(sign_digest(out.sha256.digest(), options.sign, options.passin))
+            log.write('Signature: %s\n' % options.sig)
+
+    if cache is not None:
+        log.write('Cache: %d reused, %d compressed\n' % (cache.hits, cache.misses))
 
-z = VirgoZip(sys.argv[2:], sys.argv[1])
-z.run()
-z.save()
-z.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Benchmark bundle builds with contrib/zip.py against synthetic Lua trees.
+
+Every configuration is built in a fresh child process, so wall time and
+peak RSS (from wait4) cover one build only. Results are written as JSON.
+
+Example:
+
+    python contrib/zip_bench.py --files 2000 --size lognormal:8:1 \\
+        --dup 0.1 --levels 1,6,9 --jobs 1,4 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+
+ZIP_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zip.py')
+
+WORDS = ['local', 'function', 'end', 'return', 'if', 'then', 'else', 'for',
+         'in', 'pairs', 'ipairs', 'self', 'nil', 'true', 'false', 'require',
+         'callback', 'err', 'options', 'logging', 'timer', 'table', 'string',
+         'fmt', 'client', 'connection', 'endpoint', 'msg', 'result', 'data']
+
+HEADER = """--[[
+Copyright 2015 Rackspace
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+--]]
+"""
+
+def parse_size(spec):
+    # fixed:N, uniform:MIN:MAX or lognormal:MU:SIGMA (bytes)
+    parts = spec.split(':')
+    kind, args = parts[0], [float(a) for a in parts[1:]]
+    if kind == 'fixed' and len(args) == 1:
+        return lambda rng: int(args[0])
+    if kind == 'uniform' and len(args) == 2:
+        return lambda rng: int(rng.uniform(args[0], args[1]))
+    if kind == 'lognormal' and len(args) == 2:
+        return lambda rng: int(rng.lognormvariate(args[0], args[1]))
+    raise ValueError('bad size distribution: %s' % spec)
+
+def lua_source(rng, size):
+    out = [HEADER]
+    length = len(HEADER)
+    depth = 0
+    while length < size:
+        if rng.random() < 0.1:
+            line = '-- ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10)))
+        else:
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+            line += " = '%x'" % rng.getrandbits(32)
+        line = '  ' * depth + line + '\n'
+        depth = max(0, min(6, depth + rng.choice([-1, 0, 0, 1])))
+        out.append(line)
+        length += len(line)
+    return ''.join(out)[:size]
+
+def generate_tree(root, files, size_fn, dup, seed, fanout=16):
+    rng = random.Random(seed)
+    sources = []
+    total = 0
+    for i in range(files):
+        path = os.path.join(root, 'm%d' % (i % fanout), 'sub%d' % (i // fanout % fanout),
+                            'module%d.lua' % i)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if sources and rng.random() < dup:
+            source = rng.choice(sources)
+        else:
+            source = lua_source(rng, max(1, size_fn(rng)))
+            sources.append(source)
+        with open(path, 'w') as fp:
+            fp.write(source)
+        total += len(source)
+    return total
+
+def build(args, out, root):
+    command = [sys.executable, ZIP_PY] + args + [out, root]
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        p = subprocess.Popen(command, stdout=devnull)
+        _, status, rusage = os.wait4(p.pid, 0)
+        elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('build failed: %s' % ' '.join(command))
+    return elapsed, rusage.ru_maxrss
+
+def configurations(levels, jobs, workdir):
+    # (mode, zip.py arguments, prepare) -- prepare runs before each build
+    cache = os.path.join(workdir, 'cache')
+    def clear_cache():
+        shutil.rmtree(cache, True)
+    configs = []
+    for level in levels:
+        level_args = []
+        if level is not None:
+            level_args = ['-l', str(level)]
+        for j in jobs:
+            job_args = j > 1 and ['-j', str(j)] or []
+            name = j > 1 and 'parallel' or 'serial'
+            configs.append((name, level, j, level_args + job_args, None))
+        configs.append(('cache-cold', level, 1, level_args + ['--cache', cache], clear_cache))
+        configs.append(('cache-warm', level, 1, level_args + ['--cache', cache], None))
+        configs.append(('minify', level, 1, level_args + ['--minify'], None))
+        configs.append(('dedup', level, 1, level_args + ['--dedup', '--store-ratio', '0.9'], None))
+    return configs
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--files', dest='files', type='int', default=500,
+                      help='number of Lua files in the synthetic tree (default=%default)')
+    parser.add_option('--size', dest='size', default='lognormal:8:1',
+                      help='file size distribution: fixed:N, uniform:MIN:MAX or '
+                           'lognormal:MU:SIGMA (default=%default)')
+    parser.add_option('--dup', dest='dup', type='float', default=0.0,
+                      help='fraction of files that duplicate an earlier file (default=%default)')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='random seed for the tree (default=%default)')
+    parser.add_option('--levels', dest='levels', default='default',
+                      help="comma-separated compression levels, 'default' for zlib's (default=%default)")
+    parser.add_option('--jobs', dest='jobs', default='1',
+                      help='comma-separated worker counts for the plain build (default=%default)')
+    parser.add_option('--repeat', dest='repeat', type='int', default=1,
+                      help='builds per configuration (default=%default)')
+    parser.add_option('--tree', dest='tree', default=None,
+                      help='benchmark this existing tree instead of generating one')
+    parser.add_option('--output', dest='output', default=None,
+                      help='write JSON results here instead of stdout')
+    (options, args) = parser.parse_args()
+
+    levels = [None if l == 'default' else int(l) for l in options.levels.split(',')]
+    jobs = [int(j) for j in options.jobs.split(',')]
+    workdir = tempfile.mkdtemp(prefix='zip_bench_')
+    try:
+        if options.tree:
+            root = options.tree
+            source_files = source_bytes = 0
+            for r, dirs, files in os.walk(root):
+                lua = [f for f in files if f.endswith('.lua')]
+                source_files += len(lua)
+                source_bytes += sum(os.path.getsize(os.path.join(r, f)) for f in lua)
+        else:
+            root = os.path.join(workdir, 'tree')
+            source_files = options.files
+            source_bytes = generate_tree(root, options.files, parse_size(options.size),
+                                         options.dup, options.seed)
+        sys.stderr.write('tree: %s (%d Lua files, %d bytes)\n' % (root, source_files, source_bytes))
+
+        results = []
+        out = os.path.join(workdir, 'bundle.zip')
+        for mode, level, j, zip_args, prepare in configurations(levels, jobs, workdir):
+            for trial in range(options.repeat):
+                if prepare is not None:
+                    prepare()
+                elapsed, maxrss = build(zip_args, out, root)
+                size = os.path.getsize(out)
+                result = {
+                    'mode': mode,
+                    'level': level,
+                    'jobs': j,
+                    'trial': trial,
+                    'files': source_files,
+                    'source_bytes': source_bytes,
+                    'wall_seconds': round(elapsed, 6),
+                    'peak_rss_kb': maxrss,
+                    'output_bytes': size,
+                    'ratio': source_bytes and round(float(size) / source_bytes, 6),
+                }
+                results.append(result)
+                sys.stderr.write('%-10s level=%-7s jobs=%-2d %8.3fs %8d KB %10d bytes ratio=%.3f\n'
+                                 % (mode, 'default' if level is None else level, j, elapsed,
+                                    maxrss, size, result['ratio']))
+    finally:
+        shutil.rmtree(workdir, True)
+
+    if options.tree:
+        # the generator's settings do not apply to an existing tree
+        tree = {'files': source_files, 'size': None, 'dup': None, 'seed': None,
+                'path': options.tree}
+    else:
+        tree = {'files': options.files, 'size': options.size, 'dup': options.dup,
+                'seed': options.seed, 'path': None}
+    report = {
+        'python': sys.version.split()[0],
+        'tree': tree,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()